@@ -0,0 +1,183 @@
+# ATMegaZero Auto Close Schedule
+#
+# Decides when the garage doors should be closed automatically. Two kinds of
+# rules are supported:
+#
+#   CloseAtRule(23, 30)                          every day at 11:30pm
+#   CloseAtRule(9, 0, weekdays=WORKDAYS)         at 9am from Monday to Friday
+#   OpenTooLongRule(45, doors=("door2",))        door2 has been opened for 45 minutes
+#
+# Instead of reading the RTC on every loop, the next deadline of every rule is
+# computed once from the RTC and converted to time.monotonic(), the caller only
+# has to sleep until get_next_deadline(). A CloseAtRule that was missed (the
+# board was rebooting at 11:30pm) still fires if we are within its
+# `grace_period`, even after midnight. Only occurrences after the rule's
+# `last_fired` count as missed: keep it across reboots with get_last_fired() and
+# set_last_fired(). A rule without one starts from the time of the first
+# reschedule(), so a board that has no record of being up at 11:30pm doesn't
+# close the doors when it boots at 00:45.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+
+# Weekday masks, bit 0 is Monday (struct_time.tm_wday)
+MONDAY = 1 << 0
+TUESDAY = 1 << 1
+WEDNESDAY = 1 << 2
+THURSDAY = 1 << 3
+FRIDAY = 1 << 4
+SATURDAY = 1 << 5
+SUNDAY = 1 << 6
+WORKDAYS = MONDAY | TUESDAY | WEDNESDAY | THURSDAY | FRIDAY
+WEEKENDS = SATURDAY | SUNDAY
+EVERY_DAY = WORKDAYS | WEEKENDS
+
+SECONDS_PER_DAY = 24 * 60 * 60
+# Deadlines are recomputed from the RTC at least this often (resyncs, time changes)
+MAX_SLEEP_TIME = 60 * 60
+
+def is_weekday_in_mask(epoch_seconds, weekdays):
+    return (weekdays >> time.localtime(epoch_seconds).tm_wday) & 1 == 1
+
+# Close the doors at hour:minute on the given weekdays. doors=None means every door.
+class CloseAtRule:
+    def __init__(self, hour, minute = 0, weekdays = EVERY_DAY, doors = None, grace_period = 2 * 60 * 60):
+        self.hour = hour
+        self.minute = minute
+        self.weekdays = weekdays
+        self.doors = doors
+        self.grace_period = grace_period # seconds a missed deadline still fires for
+        self.last_fired = None # epoch seconds, the occurrences up to it were handled
+
+    # Identifies the rule in the saved state, 23:30/127
+    def get_key(self):
+        return "{:02}:{:02}/{}".format(self.hour, self.minute, self.weekdays)
+
+    # Epoch seconds of the next occurrence that hasn't fired yet, it can be in the
+    # past (within the grace period) when it was missed
+    def get_next_occurrence(self, now_seconds):
+        for day in range(-1, 8):
+            t = time.localtime(now_seconds + day * SECONDS_PER_DAY)
+            occurrence = int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, self.hour, self.minute, 0, 0, -1, -1)))
+            if occurrence < now_seconds - self.grace_period:
+                continue
+            if self.last_fired is not None and occurrence <= self.last_fired:
+                continue
+            if is_weekday_in_mask(occurrence, self.weekdays):
+                return occurrence
+        return None
+
+# Close a door once it has been opened for `minutes`. doors=None means every door.
+class OpenTooLongRule:
+    def __init__(self, minutes, weekdays = EVERY_DAY, doors = None):
+        self.minutes = minutes
+        self.weekdays = weekdays
+        self.doors = doors
+
+class AutoCloseSchedule:
+    def __init__(self, rules, door_names):
+        self.close_at_rules = []
+        self.open_too_long_rules = []
+        for rule in rules:
+            if isinstance(rule, OpenTooLongRule):
+                self.open_too_long_rules.append(rule)
+            else:
+                self.close_at_rules.append(rule)
+        self.door_names = door_names
+        # monotonic deadlines: [deadline, rule, door names, occurrence epoch seconds]
+        self.deadlines = []
+        # door name -> [monotonic deadline, rule] for the doors that are opened
+        self.open_deadlines = {}
+        self.scheduled_time = None
+
+    def applies_to(self, rule, door_name):
+        return rule.doors is None or door_name in rule.doors
+
+    # Converts the CloseAtRule deadlines from the RTC time to time.monotonic()
+    def reschedule(self, now_seconds, now = None):
+        if now is None:
+            now = time.monotonic()
+        self.deadlines = []
+        for rule in self.close_at_rules:
+            if rule.last_fired is None:
+                # we don't know whether the board was up for the past occurrences
+                rule.last_fired = now_seconds
+            occurrence = rule.get_next_occurrence(now_seconds)
+            if occurrence is None:
+                continue
+            doors = rule.doors if rule.doors is not None else self.door_names
+            self.deadlines.append([now + (occurrence - now_seconds), rule, doors, occurrence])
+        self.scheduled_time = now
+
+    # rule key -> last_fired, to be saved across reboots
+    def get_last_fired(self):
+        values = {}
+        for rule in self.close_at_rules:
+            if rule.last_fired is not None:
+                values[rule.get_key()] = rule.last_fired
+        return values
+
+    def set_last_fired(self, values):
+        for rule in self.close_at_rules:
+            last_fired = values.get(rule.get_key())
+            if last_fired is not None:
+                rule.last_fired = last_fired
+
+    def door_opened(self, door_name, now = None):
+        if now is None:
+            now = time.monotonic()
+        earliest = None
+        for rule in self.open_too_long_rules:
+            if self.applies_to(rule, door_name):
+                deadline = now + rule.minutes * 60
+                if earliest is None or deadline < earliest[0]:
+                    earliest = [deadline, rule]
+        if earliest is not None:
+            self.open_deadlines[door_name] = earliest
+
+    def door_closed(self, door_name):
+        self.open_deadlines.pop(door_name, None)
+
+    # time.monotonic() value of the next deadline, never further than
+    # MAX_SLEEP_TIME away so the RTC deadlines are refreshed regularly
+    def get_next_deadline(self, now = None):
+        if now is None:
+            now = time.monotonic()
+        next_deadline = (self.scheduled_time if self.scheduled_time is not None else now) + MAX_SLEEP_TIME
+        for deadline in self.deadlines:
+            if deadline[0] < next_deadline:
+                next_deadline = deadline[0]
+        for deadline in self.open_deadlines.values():
+            if deadline[0] < next_deadline:
+                next_deadline = deadline[0]
+        return next_deadline
+
+    def needs_reschedule(self, now):
+        return self.scheduled_time is None or now - self.scheduled_time >= MAX_SLEEP_TIME
+
+    # Returns the names of the doors that are due to be closed (possibly empty)
+    # and moves the rules that fired to their next deadline
+    def pop_due_doors(self, now_seconds, now = None):
+        if now is None:
+            now = time.monotonic()
+        due = []
+        fired = False
+        for deadline, rule, doors, occurrence in self.deadlines:
+            if now >= deadline:
+                fired = True
+                rule.last_fired = occurrence
+                for name in doors:
+                    if name not in due:
+                        due.append(name)
+        if fired:
+            self.reschedule(now_seconds, now)
+
+        for name in list(self.open_deadlines):
+            deadline, rule = self.open_deadlines[name]
+            if now >= deadline:
+                if is_weekday_in_mask(now_seconds, rule.weekdays) and name not in due:
+                    due.append(name)
+                # try again later if the door is still opened by then
+                self.door_opened(name, now)
+        return due
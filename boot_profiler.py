@@ -0,0 +1,68 @@
+# ATMegaZero Boot Profiler
+#
+# Records how long each startup phase takes and how much heap is free after it,
+# so we can see which phase dominates the recovery time after a soft reboot.
+# The last few boots are kept on the SD card, one line per boot.
+#
+# For full documentation please visit https://atmegazero.com
+
+import gc
+import time
+from log import get_logger
+
+log = get_logger("boot")
+
+class BootProfiler:
+    def __init__(self):
+        self.boot_start_time = time.monotonic()
+        self.phases = [] # (name, duration in seconds, free heap in bytes)
+        self.current_phase = None
+        self.current_phase_start_time = 0
+
+    # Starts timing a new phase, ending the previous one
+    def start(self, name):
+        self.end()
+        self.current_phase = name
+        self.current_phase_start_time = time.monotonic()
+
+    def end(self):
+        if self.current_phase is None:
+            return
+        duration = time.monotonic() - self.current_phase_start_time
+        self.phases.append((self.current_phase, duration, gc.mem_free()))
+        self.current_phase = None
+
+    def get_total_time(self):
+        total = 0
+        for _, duration, _ in self.phases:
+            total += duration
+        return total
+
+    # total=6.42s shields=0.10s/120KB wifi=2.31s/118KB ...
+    def get_summary(self):
+        summary = "total={:.2f}s".format(self.get_total_time())
+        for name, duration, mem_free in self.phases:
+            summary += " {}={:.2f}s/{}KB".format(name, duration, mem_free // 1024)
+        return summary
+
+    # Appends this boot to the history file, keeping only the last `max_boots` entries
+    def save(self, path, max_boots = 10, label = None):
+        line = self.get_summary()
+        if label is not None:
+            line = "{} {}".format(label, line)
+
+        try:
+            lines = []
+            try:
+                with open(path, "r") as f:
+                    lines = f.readlines()
+            except OSError:
+                pass # first boot, there is no history yet
+
+            lines = lines[-(max_boots - 1):] if max_boots > 1 else []
+            lines.append(line + "\n")
+            with open(path, "w") as f:
+                for previous_line in lines:
+                    f.write(previous_line)
+        except Exception as e:
+            log.error("Error saving the boot times: %s", e)
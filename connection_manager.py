@@ -0,0 +1,157 @@
+# ATMegaZero Connection Manager
+#
+# Keeps the Wi-Fi radio, the socket pool and the MQTT session alive without
+# rebooting the board. When something fails only the broken layer is torn down
+# and rebuilt, retrying with a jittered exponential backoff. If a layer keeps
+# failing the recovery escalates to the next one down (MQTT session -> socket
+# pool -> Wi-Fi radio), and a full soft reboot is only the very last resort.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+import random
+import ssl
+import socketpool
+import wifi
+from log import get_logger
+
+log = get_logger("connection")
+
+class Connection_Layer:
+    mqtt = 0
+    socket_pool = 1
+    wifi = 2
+    def __init__(self, layer):
+        assert layer in (self.mqtt, self.socket_pool, self.wifi)
+        self.selection = layer
+
+LAYER_NAMES = ("MQTT session", "socket pool", "Wi-Fi radio")
+
+BACKOFF_BASE_DELAY = 1 # seconds
+BACKOFF_MAX_DELAY = 60 # seconds
+ATTEMPTS_PER_LAYER = 3 # failed attempts before escalating to the next layer down
+MAX_RECOVERY_ATTEMPTS = 12 # failed attempts before giving up and rebooting
+
+class ConnectionManager:
+    def __init__(self, ssid, password, create_mqtt_client, on_give_up = None,
+                 base_delay = BACKOFF_BASE_DELAY, max_delay = BACKOFF_MAX_DELAY,
+                 attempts_per_layer = ATTEMPTS_PER_LAYER, max_attempts = MAX_RECOVERY_ATTEMPTS):
+        self.ssid = ssid
+        self.password = password
+        # create_mqtt_client(pool, ssl_context) returns a new, not yet connected, MQTT client
+        self.create_mqtt_client = create_mqtt_client
+        # called when every recovery attempt failed (soft reboot)
+        self.on_give_up = on_give_up
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts_per_layer = attempts_per_layer
+        self.max_attempts = max_attempts
+
+        self.pool = None
+        self.ssl_context = None
+        self.mqtt_client = None
+
+        self.failed_layer = None
+        self.failure_count = 0
+        self.layer_attempts = 0
+        self.next_attempt_time = 0
+        self.recovery_count = 0
+
+    def is_connected(self):
+        return self.failed_layer is None and self.mqtt_client is not None
+
+    def connect_wifi(self):
+        log.info("Connecting to %s", self.ssid)
+        wifi.radio.connect(self.ssid, self.password)
+        log.info("Connected to %s!", self.ssid)
+        log.info("my IP addr: %s", wifi.radio.ipv4_address)
+
+    def connect_mqtt(self):
+        if self.pool is None:
+            self.create_socket_pool()
+        if self.mqtt_client is None:
+            self.mqtt_client = self.create_mqtt_client(self.pool, self.ssl_context)
+
+        # on_connect will (re)subscribe to the feeds
+        log.info("Connecting to Adafruit IO...")
+        self.mqtt_client.connect()
+
+    def create_socket_pool(self):
+        self.pool = socketpool.SocketPool(wifi.radio)
+        self.ssl_context = ssl.create_default_context()
+        # the old client holds sockets from the old pool
+        self.mqtt_client = None
+
+    # Figures out which layer broke, an MQTT error with the radio down is a Wi-Fi problem.
+    def get_failed_layer(self):
+        if wifi.radio.ipv4_address is None:
+            return Connection_Layer.wifi
+        return Connection_Layer.mqtt
+
+    def report_failure(self, layer = None):
+        if layer is None:
+            layer = self.get_failed_layer()
+
+        if self.failed_layer is None:
+            self.failed_layer = layer
+            self.layer_attempts = 0
+            self.schedule_next_attempt()
+        elif layer > self.failed_layer:
+            self.failed_layer = layer
+            self.layer_attempts = 0
+
+    def schedule_next_attempt(self):
+        delay = min(self.max_delay, self.base_delay * (2 ** self.failure_count))
+        # jitter between half and the full delay so we don't retry in lockstep with the broker
+        delay = delay / 2 + random.random() * delay / 2
+        self.next_attempt_time = time.monotonic() + delay
+        log.info("Retrying the %s in %.1f seconds", LAYER_NAMES[self.failed_layer], delay)
+
+    # Meant to be called periodically. Returns True when a connection was just recovered.
+    def update(self):
+        if self.failed_layer is None or time.monotonic() < self.next_attempt_time:
+            return False
+
+        layer = self.failed_layer
+        log.info("Recovering the %s", LAYER_NAMES[layer])
+        try:
+            self.recover(layer)
+        except Exception as e:
+            log.warning("Failed to recover the %s: %s", LAYER_NAMES[layer], e)
+            self.failure_count += 1
+            self.layer_attempts += 1
+            if self.failure_count >= self.max_attempts:
+                if self.on_give_up is not None:
+                    self.on_give_up()
+                return False
+
+            # keep failing at this layer, tear down the one below it next time
+            if self.layer_attempts >= self.attempts_per_layer and self.failed_layer < Connection_Layer.wifi:
+                self.failed_layer += 1
+                self.layer_attempts = 0
+            self.schedule_next_attempt()
+            return False
+
+        self.failed_layer = None
+        self.failure_count = 0
+        self.layer_attempts = 0
+        self.recovery_count += 1
+        return True
+
+    def recover(self, layer):
+        if layer == Connection_Layer.wifi:
+            # bounce the radio, the socket pool object stays valid
+            wifi.radio.enabled = False
+            wifi.radio.enabled = True
+            self.connect_wifi()
+
+        if layer == Connection_Layer.socket_pool:
+            self.create_socket_pool()
+
+        if self.mqtt_client is not None:
+            try:
+                self.mqtt_client.disconnect()
+            except Exception:
+                pass # the session is already broken
+
+        self.connect_mqtt()
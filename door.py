@@ -0,0 +1,120 @@
+# ATMegaZero Garage Door
+#
+# One garage door: its magnetic switch, the relay that drives the opener and the
+# adafruit.io feeds used to control it and report its status. Doors are built
+# from the DOORS configuration in garage_manager.py, so adding a door is a
+# matter of adding an entry there.
+#
+# Every time the relay is pulsed the door goes to OPENING or CLOSING and waits
+# for the magnetic switch to confirm it got there. If it doesn't within
+# `travel_timeout` seconds the relay is pulsed again (up to `max_retries` times)
+# and then the door goes to FAULT. The time each confirmed move took goes into a
+# histogram.
+#
+# For full documentation please visit https://atmegazero.com
+
+from door_sensor import DoorSensor, DEFAULT_DEBOUNCE_TIME
+from latency_monitor import Histogram
+
+# The settled states keep the values the status feed always had (0 closed, 1 opened)
+class Door_State:
+    closed = 0
+    open = 1
+    opening = 2
+    closing = 3
+    fault = 4
+    def __init__(self, state):
+        assert state in (self.closed, self.open, self.opening, self.closing, self.fault)
+        self.selection = state
+
+STATE_NAMES = ("CLOSED", "OPEN", "OPENING", "CLOSING", "FAULT")
+
+DEFAULT_TRAVEL_TIMEOUT = 20 # seconds
+DEFAULT_MAX_RETRIES = 1
+# Upper bound (in seconds) of each travel time histogram bucket
+TRAVEL_TIME_BUCKETS = (4, 6, 8, 10, 12, 14, 16, 18, 20, 25, 30)
+
+class Door:
+    def __init__(self, name, sensor_pin, relay, button_feed, status_feed,
+                 status_led = None, closed_led = None, debounce_time = DEFAULT_DEBOUNCE_TIME,
+                 travel_timeout = DEFAULT_TRAVEL_TIMEOUT, max_retries = DEFAULT_MAX_RETRIES):
+        self.name = name
+        self.relay = relay
+        self.button_feed = button_feed
+        self.status_feed = status_feed
+        # LED turned on while the door is opened, and optionally one while it is closed
+        self.status_led = status_led
+        self.closed_led = closed_led
+
+        self.travel_timeout = travel_timeout
+        self.max_retries = max_retries
+        self.retries_left = 0
+        self.travel_started_time = 0
+        self.travel_deadline = 0
+        self.travel_times = Histogram(TRAVEL_TIME_BUCKETS) # seconds
+        self.fault_count = 0
+
+        # Called with (door, is_opened) when the debounced sensor value changes
+        self.on_change = None
+        # Called with (door, state) when the state changes
+        self.on_state_change = None
+        # Called with the door when its relay has to be pulsed again
+        self.on_retry = None
+        self.sensor = DoorSensor(sensor_pin, debounce_time=debounce_time, on_change=self._sensor_changed, name=name)
+        self.is_opened = self.sensor.value
+        self.state = Door_State.open if self.is_opened else Door_State.closed
+
+    def is_moving(self):
+        return self.state == Door_State.opening or self.state == Door_State.closing
+
+    # Call this right after the relay was pulsed
+    def start_travel(self, now):
+        self.retries_left = self.max_retries
+        self._start_travel(Door_State.closing if self.is_opened else Door_State.opening, now)
+
+    # Something else (the motor going quiet) says the door isn't getting there,
+    # don't wait for the whole travel timeout
+    def shorten_travel(self, deadline):
+        if self.is_moving() and deadline < self.travel_deadline:
+            self.travel_deadline = deadline
+
+    def update(self, now):
+        self.sensor.update(now)
+        if self.is_moving() and now >= self.travel_deadline:
+            if self.retries_left > 0:
+                self.retries_left -= 1
+                self._start_travel(self.state, now)
+                if self.on_retry is not None:
+                    self.on_retry(self)
+            else:
+                self.fault_count += 1
+                self._set_state(Door_State.fault)
+
+    # p50=12.0 p95=14.0 max=13.2 n=8 faults=0 (seconds)
+    def get_travel_summary(self):
+        histogram = self.travel_times
+        return "p50={:.1f} p95={:.1f} max={:.1f} n={} faults={}".format(histogram.percentile(0.5), histogram.percentile(0.95),
+                                                              histogram.max_value, histogram.count, self.fault_count)
+
+    def _start_travel(self, state, now):
+        self.travel_started_time = now
+        self.travel_deadline = now + self.travel_timeout
+        self._set_state(state)
+
+    def _sensor_changed(self, sensor, is_opened):
+        self.is_opened = is_opened
+        if self.on_change is not None:
+            self.on_change(self, is_opened)
+
+        if (self.state == Door_State.opening and is_opened) or (self.state == Door_State.closing and not is_opened):
+            self.travel_times.add(sensor.last_changed_time - self.travel_started_time)
+        # A confirmed move, someone using the wall button or a door recovering from
+        # a fault: either way the sensor has the last word.
+        self._set_state(Door_State.open if is_opened else Door_State.closed)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if self.on_state_change is not None:
+            self.on_state_change(self, state)
@@ -0,0 +1,50 @@
+# ATMegaZero Door Sensor
+#
+# Debounced, edge-triggered reader for the magnetic door switches. The sensor is
+# polled at a high rate from a scheduler task and only reports a change once the
+# new reading has been stable for `debounce_time` seconds, so contact bounce from
+# a moving door never turns into a burst of status messages.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+from digitalio import DigitalInOut, Pull, Direction
+
+DEFAULT_DEBOUNCE_TIME = 0.05 # 50ms
+
+class DoorSensor:
+    def __init__(self, pin, debounce_time = DEFAULT_DEBOUNCE_TIME, on_change = None, name = None):
+        self.name = name
+        self.debounce_time = debounce_time
+        self.on_change = on_change
+
+        # The magnetic switch is open (True) while the door is opened
+        self.input = DigitalInOut(pin)
+        self.input.direction = Direction.INPUT
+        self.input.pull = Pull.UP
+
+        self.value = bool(self.input.value)
+        self.last_changed_time = time.monotonic()
+        self._candidate_value = self.value
+        self._candidate_since = self.last_changed_time
+
+    # Samples the pin once. Returns True when the debounced value changed.
+    def update(self, now = None):
+        if now is None:
+            now = time.monotonic()
+
+        raw_value = bool(self.input.value)
+        if raw_value != self._candidate_value:
+            # The reading moved, restart the debounce window
+            self._candidate_value = raw_value
+            self._candidate_since = now
+            return False
+
+        if raw_value == self.value or (now - self._candidate_since) < self.debounce_time:
+            return False
+
+        self.value = raw_value
+        self.last_changed_time = now
+        if self.on_change is not None:
+            self.on_change(self, raw_value)
+        return True
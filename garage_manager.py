@@ -12,56 +12,95 @@
 # Created by: Eddie Espinal (@4hackrr)
 # For full documentation please visit https://atmegazero.com
 
-import sys
 import time
 import board
 import busio
-from digitalio import DigitalInOut, Pull, Direction
+from digitalio import DigitalInOut
 import neopixel
 
-import ssl
-import socketpool
-import wifi
+import json
 import adafruit_minimqtt.adafruit_minimqtt as MQTT
-from adafruit_io.adafruit_io import IO_HTTP, AdafruitIO_RequestError
 
-from sensors_shield import ATMegaZero_Sensors_Shield as SensorsShield, Temperature_Type
-from learning_shield import ATMegaZero_Learning_Shield as LearningShield, LED
+from sensors_shield import ATMegaZero_Sensors_Shield as SensorsShield
+from learning_shield import ATMegaZero_Learning_Shield as LearningShield, LED, Indicator
 from relay_shield import ATMegaZero_Relay_Shield as RelayShield, Relay
-from adafruit_io_helper import AdafruitIOHelper
+from scheduler import Scheduler
+from door import Door, Door_State, STATE_NAMES
+from pattern_sequencer import Pattern
+from sd_logger import SDLogger
+from boot_profiler import BootProfiler
+from connection_manager import ConnectionManager, Connection_Layer
+from latency_monitor import LatencyMonitor, Latency_Stage
+from memory_monitor import MemoryMonitor
+from report_policy import ReportPolicy, FeedReporter
+from telemetry_queue import TelemetryQueue
+from voc_alert import VOCAlert
+from time_series_store import TimeSeriesStore, FIELDS as HISTORY_FIELDS, NAN
+from state_sync import StateSync
+from auto_close_schedule import AutoCloseSchedule, CloseAtRule, OpenTooLongRule, WORKDAYS
+from log import get_logger, set_level, add_sink, Log_Level
 
 import adafruit_sdcard
 import storage
 import supervisor
 
+log = get_logger("garage")
+
 try:
     from secrets import secrets
 except ImportError:
-    print("WiFi secrets are kept in secrets.py, please add them there!")
+    log.error("WiFi secrets are kept in secrets.py, please add them there!")
     raise
 
 aio_username = secrets["aio_username"]
 aio_key = secrets["aio_key"]
 
-# Relays Feed
-door1button_feed = secrets["aio_username"] + "/feeds/garagegroup.door1button"
-door2button_feed = secrets["aio_username"] + "/feeds/garagegroup.door2button"
-relay3_feed = secrets["aio_username"] + "/feeds/garagegroup.relay3"
-relay4_feed = secrets["aio_username"] + "/feeds/garagegroup.relay4"
+# Every feed lives in this group on adafruit.io
+GROUP_KEY = "garagegroup"
+
+# username/feeds/garagegroup.<key>
+def get_feed(key):
+    return secrets["aio_username"] + "/feeds/" + GROUP_KEY + "." + key
+
+# Doors, each one has a magnetic switch, the relay that drives its opener and an
+# LED on the learning shield. The <name>button and <name>status feeds are used to
+# control it and report its status. Add an entry for every door (one per relay).
+# "pulse_width" and "min_retrigger_interval" (seconds) are optional, see RELAY_*,
+# as well as "travel_timeout" and "max_retries", see DOOR_*.
+DOORS = [
+    {"name": "door1", "sensor_pin": board.D10, "relay": Relay.one, "status_led": LED.red, "closed_led": LED.green},
+    {"name": "door2", "sensor_pin": board.D9, "relay": Relay.two, "status_led": LED.yellow},
+]
 
-# Status Feed
-door1status_feed = secrets["aio_username"] + "/feeds/garagegroup.door1status"
-door2status_feed = secrets["aio_username"] + "/feeds/garagegroup.door2status"
+# Spare relays Feed
+relay3_feed = get_feed("relay3")
+relay4_feed = get_feed("relay4")
+
+# Boot time summary Feed
+boot_time_feed = get_feed("boot-time")
+
+# Diagnostics Feed (command latency)
+diagnostics_feed = get_feed("diagnostics")
 
 # Auto close doors switch Feed
-auto_close_doors_feed = secrets["aio_username"] + "/feeds/garagegroup.auto-close-doors"
+auto_close_doors_feed = get_feed("auto-close-doors")
 
 # Sensors Feed
-temperature_feed = secrets["aio_username"] + "/feeds/garagegroup.temperature"
-humidity_feed = secrets["aio_username"] + "/feeds/garagegroup.humidity"
-hpa_feed = secrets["aio_username"] + "/feeds/garagegroup.hpa"
-brightness_feed = secrets["aio_username"] + "/feeds/garagegroup.brightness"
-raw_gas_feed = secrets["aio_username"] + "/feeds/garagegroup.gas"
+temperature_feed = get_feed("temperature")
+humidity_feed = get_feed("humidity")
+hpa_feed = get_feed("hpa")
+brightness_feed = get_feed("brightness")
+raw_gas_feed = get_feed("gas") # no longer published, see voc_index_feed
+voc_index_feed = get_feed("voc-index")
+voc_alert_feed = get_feed("voc-alert")
+
+# Group Feed, lets us send every garagegroup value in a single publish
+garage_group_feed = secrets["aio_username"] + "/groups/" + GROUP_KEY
+
+# Publish all the telemetry as one group message (one TLS write and one request
+# against the adafruit.io rate limit) instead of one message per feed.
+# Set to False to always publish to each feed individually.
+USE_GROUP_PUBLISH = True
 
 # Connect to the SD Card and mount the filesystem.
 SD_CS = board.SD_CS
@@ -73,362 +112,960 @@ storage.mount(vfs, "/sd")
 
 LOG_FILE = "atmegazero_logs.txt"
 
+# Log messages are buffered in RAM and written to the SD card in batches
+LOG_BUFFER_SIZE = 2048 # bytes, preallocated once
+LOG_FLUSH_THRESHOLD = 1536 # flush once the buffer holds this many bytes
+LOG_FLUSH_INTERVAL = 30 # or at least every 30 seconds
+LOG_MAX_FILE_SIZE = 256 * 1024 # rotate the log file once it reaches 256KB
+LOG_MAX_FILES = 3 # number of rotated log files to keep
+# Messages below LOG_LEVEL cost nothing, set it to Log_Level.debug while troubleshooting.
+# Errors are also written to the SD card log (log_to_sd_card() always is).
+LOG_LEVEL = Log_Level.info
+SD_LOG_LEVEL = Log_Level.error
+
+# Telemetry that couldn't be published is kept on the SD card and replayed
+# (oldest first) once we are connected again.
+TELEMETRY_QUEUE_FILE = "telemetry_queue.bin"
+TELEMETRY_QUEUE_MAX_RECORDS = 20000 # 9 bytes each, ~180KB
+TELEMETRY_QUEUE_REPLAY_INTERVAL = 5 # seconds between replay runs
+# Values replayed per run on average: 48 per minute, which leaves room for the
+# live telemetry under the adafruit.io limit of 60 data points per minute (IO+).
+# A run that can't use all of its share (the next message doesn't fit) leaves it
+# to the next run.
+TELEMETRY_QUEUE_REPLAY_VALUES = 4
+TELEMETRY_QUEUE_REPLAY_BATCH = 60 # records read from the card at once
+# Hours to add to the RTC time to get UTC, the replayed data is sent with its original timestamp
+RTC_UTC_OFFSET_HOURS = 0
+
+# Local sensor history on the SD card (see time_series_store.py): one binary
+# record every HISTORY_RECORD_INTERVAL seconds plus per-minute and per-hour
+# rollups, ~330KB per day at 10 seconds. Days older than HISTORY_MAX_DAYS are deleted.
+HISTORY_DIR = "history"
+HISTORY_RECORD_INTERVAL = 10
+HISTORY_MAX_DAYS = 90
+
+# Startup phase timings of the last few boots
+BOOT_TIMES_FILE = "boot_times.txt"
+BOOT_TIMES_HISTORY_SIZE = 10
+
+# How often the command latency percentiles are published to the diagnostics feed
+DIAGNOSTICS_PUBLISH_INTERVAL = 5 * 60 # every 5 minutes
+
+# Heap instrumentation, the diagnostics include the free heap, its low water
+# mark and the tasks that allocate the most.
+PROFILE_TASK_MEMORY = True # record the heap usage of every task run
+GC_INTERVAL = 60 # run gc.collect() at an idle point every minute, 0 leaves it to the VM
+GC_MIN_FREE = 16 * 1024 # or as soon as less than 16KB are free
+
+# Only these sensor drivers are loaded (lazily, on first use), see sensors_shield.py
+ENABLED_SENSORS = ("bme280", "rtc", "sgp40", "ads1115", "mpu6050")
+
 # This will help not send too many request too fast to adafruit.io
 PUBLISH_TIME_INTERVAL = 60 # every 60 seconds
 
-# Close garage automatically at 11:30pm
-AUTO_CLOSE_DOORS_AFTER_HOUR = 23 # 11PM in 24hr format
-AUTO_CLOSE_DOORS_AFTER_MINUTES = 30
-AUTO_CLOSE_WAIT_TIME_IN_MINUTES = 30 * 60 # 30 mins wait time before trying to auto close doors again.
-
-# Door1 Magnetic Switch Sensors
-door1_magnetic_sensor = DigitalInOut(board.D10)
-door1_magnetic_sensor.direction = Direction.INPUT
-door1_magnetic_sensor.pull = Pull.UP
-
-# Door2 Magnetic Switch Sensors
-door2_magnetic_sensor = DigitalInOut(board.D9)
-door2_magnetic_sensor.direction = Direction.INPUT
-door2_magnetic_sensor.pull = Pull.UP
+# Report-by-exception: the telemetry is checked every few seconds but a feed is
+# only published when its value moved past the feed's deadband (and not more
+# often than its min_interval), or as a heartbeat every max_interval.
+TELEMETRY_CHECK_INTERVAL = 5
+HEARTBEAT_INTERVAL = 15 * 60 # every 15 minutes
+REPORT_POLICIES = {
+    temperature_feed: ReportPolicy(deadband=0.5, min_interval=PUBLISH_TIME_INTERVAL, max_interval=HEARTBEAT_INTERVAL),
+    humidity_feed: ReportPolicy(deadband=2.0, min_interval=PUBLISH_TIME_INTERVAL, max_interval=HEARTBEAT_INTERVAL),
+    hpa_feed: ReportPolicy(deadband=1.0, min_interval=PUBLISH_TIME_INTERVAL, max_interval=HEARTBEAT_INTERVAL),
+    # a door opening changes the light a lot, let that go out quickly
+    brightness_feed: ReportPolicy(deadband_percent=10, min_interval=TELEMETRY_CHECK_INTERVAL, max_interval=HEARTBEAT_INTERVAL),
+    voc_index_feed: ReportPolicy(deadband=10, min_interval=PUBLISH_TIME_INTERVAL, max_interval=HEARTBEAT_INTERVAL),
+}
+for door_config in DOORS:
+    # door changes are published as they happen, this is only the heartbeat
+    REPORT_POLICIES[get_feed(door_config["name"] + "status")] = ReportPolicy(min_interval=TELEMETRY_CHECK_INTERVAL, max_interval=HEARTBEAT_INTERVAL)
+
+# The sensors are sampled in the background (see SAMPLE_RATES in sensors_shield.py)
+# and the windowed average is published instead of a single noisy reading.
+SENSOR_SAMPLING_INTERVAL = 0.25
+FIRST_PUBLISH_DELAY = 5 # give the sampling engine a few samples before the first publish
+# Also publish the window min/max as <feed>-min and <feed>-max (uses more data points)
+PUBLISH_MIN_MAX = False
+
+# When to close the garage automatically (see auto_close_schedule.py), e.g.
+#   CloseAtRule(22, 0, weekdays=WORKDAYS)          10pm from Monday to Friday
+#   OpenTooLongRule(45, doors=("door2",))          door2 opened for 45 minutes
+AUTO_CLOSE_RULES = [
+    CloseAtRule(23, 30), # every night at 11:30pm
+]
+AUTO_CLOSE_DOORS_DEFAULT = False # until adafruit.io (or the SD card) says otherwise
+
+# The settings on adafruit.io (auto close) are requested over
+# MQTT every time we connect. The last known values are kept on the SD card and
+# used when adafruit.io doesn't answer within STATE_SYNC_TIMEOUT seconds.
+STATE_FILE = "garage_state.json"
+# Not synced with adafruit.io, only kept on the SD card
+AUTO_CLOSE_STATE_KEY = "auto-close-last-fired"
+STATE_SYNC_TIMEOUT = 5
+STATE_SYNC_CHECK_INTERVAL = 1
+AUTO_CLOSE_RETRY_INTERVAL = 10 # seconds, after the auto close schedule failed
+
+# Cooperative task intervals (in seconds). The MQTT poll interval bounds how long
+# a command from the dashboard can wait before it reaches the relays.
+MQTT_POLL_INTERVAL = 0.05
+CONNECTION_CHECK_INTERVAL = 0.5
+INDICATOR_UPDATE_INTERVAL = 0.5
+
+# The door switches are sampled at a high rate so a door status change reaches
+# adafruit.io within ~100ms. The periodic publish is only a heartbeat.
+DOOR_SENSOR_POLL_INTERVAL = 0.01 # 10ms
+DOOR_SENSOR_DEBOUNCE_TIME = 0.05 # a reading must be stable for 50ms
+
+# After the relay is pulsed the magnetic switch has to confirm the door moved
+# within DOOR_TRAVEL_TIMEOUT seconds, otherwise the relay is pulsed again up to
+# DOOR_MAX_RETRIES times before the door is reported as faulty.
+DOOR_TRAVEL_TIMEOUT = 20
+DOOR_MAX_RETRIES = 1
+
+# With "mpu6050" in ENABLED_SENSORS the accelerometer feels the door motors (see
+# vibration_monitor.py). A moving door is retried (or reported as faulty) early
+# when the motor didn't start within DOOR_MOTOR_START_TIMEOUT seconds of the
+# relay pulse, or when the motor stopped and the switch still hasn't confirmed
+# the move DOOR_MOTOR_STOP_GRACE seconds later.
+VIBRATION_CHECK_INTERVAL = 0.1 # the MPU6050 FIFO holds ~850ms of samples
+DOOR_MOTOR_START_TIMEOUT = 3
+DOOR_MOTOR_STOP_GRACE = 2
+
+# The SGP40 VOC index (100 is the 24 hour average, see voc_alert.py) raises an
+# alert when it stays high, like with a car idling in the closed garage. The
+# alert is published to the voc-alert feed (1 raised, 0 cleared), beeps and
+# energizes VENTILATION_RELAY (a fan or a vent opener) until it clears.
+VOC_ALERT_CHECK_INTERVAL = 1 # the VOC index is sampled every second
+VOC_ALERT_THRESHOLD = 250
+VOC_CLEAR_THRESHOLD = 150
+VOC_ALERT_SUSTAIN_TIME = 60 # seconds at or above VOC_ALERT_THRESHOLD to raise the alert
+VOC_ALERT_CLEAR_TIME = 120 # seconds below VOC_CLEAR_THRESHOLD to clear it
+VENTILATION_RELAY = None # e.g. Relay.three, None when nothing is wired
+
+# Relays are pulsed without blocking, this task releases them when the pulse is
+# over so its interval is the pulse width resolution.
+RELAY_UPDATE_INTERVAL = 0.02
+RELAY_PULSE_WIDTH = 0.5 # how long the opener's button is "pressed"
+# A second press while the door is moving stops it, ignore repeated commands
+RELAY_MIN_RETRIGGER_INTERVAL = 2
+
+# LEDs, buzzer and NeoPixel are driven by patterns, this is the tick of the
+# pattern sequencer. When two patterns want the same output the highest
+# priority one wins.
+PATTERN_UPDATE_INTERVAL = 0.02
+STATUS_PRIORITY = 0
+COMMAND_PRIORITY = 1
+WARNING_PRIORITY = 2
+DOOR_STATUS_PATTERN = Pattern(on_time=1, repeats=0, priority=STATUS_PRIORITY)
+BOOT_PATTERN = Pattern(on_time=1, repeats=0, priority=WARNING_PRIORITY) # yellow LED while initializing
+READY_BEEP_PATTERN = Pattern(on_time=0.25, off_time=0.25, repeats=2)
+CONNECTION_ERROR_PATTERN = Pattern(on_time=1, repeats=0, priority=WARNING_PRIORITY) # red LED until reconnected
+COMMAND_LED_PATTERN = Pattern(on_time=RELAY_PULSE_WIDTH, priority=COMMAND_PRIORITY)
+COMMAND_PIXEL_PATTERN = Pattern(on_time=RELAY_PULSE_WIDTH, priority=COMMAND_PRIORITY, value=(0, 0, 255))
+COMMAND_BEEP_PATTERN = Pattern(on_time=0.1, priority=COMMAND_PRIORITY)
+AUTO_CLOSE_WARNING_PATTERN = Pattern(on_time=1.0, off_time=1.0, repeats=5, priority=WARNING_PRIORITY)
+AUTO_CLOSE_FINAL_WARNING_PATTERN = Pattern(on_time=0.1, off_time=0.1, repeats=10, priority=WARNING_PRIORITY)
+AUTO_CLOSE_CLOSING_PATTERN = Pattern(on_time=0.2, off_time=0.2, repeats=3, priority=WARNING_PRIORITY)
+DOOR_FAULT_PATTERN = Pattern(on_time=0.25, off_time=0.25, repeats=0, priority=WARNING_PRIORITY) # red LED
+VOC_ALERT_BEEP_PATTERN = Pattern(on_time=0.5, off_time=0.5, repeats=3, priority=WARNING_PRIORITY)
+VOC_ALERT_LED_PATTERN = Pattern(on_time=0.5, off_time=1.5, repeats=0, priority=WARNING_PRIORITY) # yellow LED
+
+def create_doors():
+    doors = []
+    for config in DOORS:
+        name = config["name"]
+        doors.append(Door(name, config["sensor_pin"], config["relay"],
+                          button_feed=get_feed(name + "button"),
+                          status_feed=get_feed(name + "status"),
+                          status_led=config.get("status_led"),
+                          closed_led=config.get("closed_led"),
+                          debounce_time=DOOR_SENSOR_DEBOUNCE_TIME,
+                          travel_timeout=config.get("travel_timeout", DOOR_TRAVEL_TIMEOUT),
+                          max_retries=config.get("max_retries", DOOR_MAX_RETRIES)))
+    return doors
+
+# Feeds that are queued on the SD card while offline, the order is part of the
+# file format, only append to this list. The door feeds come last so adding a
+# door doesn't change the id of any other feed.
+QUEUED_FEEDS = [
+    temperature_feed,
+    humidity_feed,
+    hpa_feed,
+    brightness_feed,
+    raw_gas_feed,
+    voc_index_feed,
+]
+
+# Formatting applied to a feed's value right before it is published, the
+# sensors and the telemetry queue only deal with numbers.
+FEED_VALUE_FORMATS = {
+    hpa_feed: "%0.1f",
+    voc_index_feed: "%d",
+}
+
+for door_config in DOORS:
+    QUEUED_FEEDS.append(get_feed(door_config["name"] + "status"))
+    FEED_VALUE_FORMATS[get_feed(door_config["name"] + "status")] = "%d"
+
+# username/feeds/garagegroup.temperature -> temperature
+def get_feed_key(feed):
+    return feed[feed.rindex(".") + 1:]
 
 class Garage_Manager:
     def __init__(self, *args):
-        self.sensors_shield = SensorsShield()
+        set_level(LOG_LEVEL)
+        self.boot_profiler = BootProfiler()
+        # published on the first successful connection, see publish_boot_times()
+        self.boot_times_summary = None
+        self.boot_profiler.start("shields")
+        self.sensors_shield = SensorsShield(enabled_sensors=ENABLED_SENSORS)
         self.learning_shield = LearningShield()
         self.relay_shield = RelayShield()
+        self.latency_monitor = LatencyMonitor()
+        self.memory_monitor = MemoryMonitor(gc_interval=GC_INTERVAL, gc_min_free=GC_MIN_FREE)
+        self.feed_reporter = FeedReporter(REPORT_POLICIES)
+        self.telemetry_queue = TelemetryQueue(f"/sd/{TELEMETRY_QUEUE_FILE}", QUEUED_FEEDS, TELEMETRY_QUEUE_MAX_RECORDS)
+        self.telemetry_replay_credit = 0 # values the replay may still send, see TELEMETRY_QUEUE_REPLAY_VALUES
+        self.voc_alert = VOCAlert(threshold=VOC_ALERT_THRESHOLD, clear_threshold=VOC_CLEAR_THRESHOLD,
+                                  sustain_time=VOC_ALERT_SUSTAIN_TIME, clear_time=VOC_ALERT_CLEAR_TIME)
+        self.voc_alert.on_change = self.voc_alert_changed
+        self.history = TimeSeriesStore(f"/sd/{HISTORY_DIR}", door_count=len(DOORS), max_days=HISTORY_MAX_DAYS)
+        self.relay_shield.on_relay_energized = self.relay_energized
+        for door_config in DOORS:
+            self.relay_shield.configure_relay(door_config["relay"],
+                                              pulse_width=door_config.get("pulse_width", RELAY_PULSE_WIDTH),
+                                              min_retrigger_interval=door_config.get("min_retrigger_interval", RELAY_MIN_RETRIGGER_INTERVAL))
+        self.logger = SDLogger(f"/sd/{LOG_FILE}",
+                               time_source=self.sensors_shield.get_date_time,
+                               buffer_size=LOG_BUFFER_SIZE,
+                               flush_threshold=LOG_FLUSH_THRESHOLD,
+                               flush_interval=LOG_FLUSH_INTERVAL,
+                               max_file_size=LOG_MAX_FILE_SIZE,
+                               max_files=LOG_MAX_FILES)
+        add_sink(self.logger.log, SD_LOG_LEVEL)
 
         # let's turn on the Yellow LED while we initialize the board and connect to the internet and mqtt
-        self.learning_shield.turn_led_on(LED.yellow)
+        self.learning_shield.play_pattern(Indicator.yellow, "boot", BOOT_PATTERN)
 
         self.pixel = neopixel.NeoPixel(board.NEOPIXEL, 1, pixel_order=neopixel.RGB)
-        self.last_published_time = 0
+        self.learning_shield.sequencer.add_channel(Indicator.pixel, self.set_pixel, idle_value=(0, 0, 0))
         self.is_automatically_closing_garage_doors = False
         self.automatically_closed_datetime_tuple = None
-        self.last_auto_close_time = 0
-        
+        self.auto_close_schedule_task = None
+        self.scheduler = Scheduler()
+        if PROFILE_TASK_MEMORY:
+            self.scheduler.memory_monitor = self.memory_monitor
+        # collect garbage between tasks rather than in the middle of one
+        self.scheduler.on_idle = self.memory_monitor.collect_if_due
+        self.doors = create_doors()
+        # topic -> (handler, argument)
+        self.topic_handlers = self.create_topic_handlers()
+        self.state_handlers = self.create_state_handlers()
+        self.auto_close_schedule = AutoCloseSchedule(AUTO_CLOSE_RULES, [door.name for door in self.doors])
+        for door in self.doors:
+            if door.is_opened:
+                self.auto_close_schedule.door_opened(door.name)
+
+        # start from the state saved on the SD card, adafruit.io updates it once connected
+        self.enable_close_doors_automatically = AUTO_CLOSE_DOORS_DEFAULT
+        self.state_sync = StateSync(f"/sd/{STATE_FILE}", timeout=STATE_SYNC_TIMEOUT)
+        for topic, value in self.state_sync.values.items():
+            self.restore_state(topic, value)
+        self.auto_close_schedule.set_last_fired(self.state_sync.get(AUTO_CLOSE_STATE_KEY, {}))
+
+        self.connection = ConnectionManager(secrets["ssid"], secrets["password"],
+                                            self.create_mqtt_client,
+                                            on_give_up=self.reconnect)
+
+        self.boot_profiler.start("wifi")
         self.connect_to_wifi()
+        self.boot_profiler.start("mqtt")
         self.connect_to_mqtt()
-        
-        # get the default values from adafruit io
-        self.set_default_values()
 
         # turn off the Yellow LED to indicate we are done initializing
-        self.learning_shield.turn_led_off(LED.yellow)
+        self.learning_shield.stop_pattern(Indicator.yellow, "boot")
 
         # make an audiable signal that we are done initializing
-        self.learning_shield.beep_by(2, delay = 0.25)
+        self.learning_shield.play_pattern(Indicator.buzzer, "ready", READY_BEEP_PATTERN)
 
-        self.door1_is_opened = False
-        self.door2_is_opened = False
+        for door in self.doors:
+            door.on_change = self.door_status_changed
+            door.on_state_change = self.door_state_changed
+            door.on_retry = self.retry_door
 
+        self.boot_profiler.start("initial_log")
         self.log_to_sd_card("Initialized")
 
-        # Start a blocking loop to check for new messages
+        self.boot_profiler.start("tasks")
+        self.sensors_shield.start_sampling()
+        self.vibration_monitor = None
+        if "mpu6050" in ENABLED_SENSORS:
+            self.start_vibration_monitor()
+        self.start_tasks()
+        self.boot_profiler.end()
+        self.report_boot_times()
+
+        # Run the first scheduler pass to check for new messages
         self.loop()
 
-    def loop(self):
-        try:
-            self.mqtt_client.loop()
-        except Exception as e:
-            print("Failed to get data, retrying\n", e)
-            self.log_to_sd_card("Failed while running the mqtt_client_loop() inside loop() function")
-            self.learning_shield.turn_led_on(LED.red)
-            self.reconnect()
+    def start_tasks(self):
+        # Every piece of work is a small cooperative task so no single step can
+        # hold up the MQTT loop (and therefore the commands from the dashboard).
+        self.scheduler.every(MQTT_POLL_INTERVAL, self.service_mqtt, name="mqtt")
+        self.scheduler.every(RELAY_UPDATE_INTERVAL, self.relay_shield.update, name="relays")
+        self.scheduler.every(PATTERN_UPDATE_INTERVAL, self.learning_shield.update_patterns, name="patterns")
+        self.scheduler.every(CONNECTION_CHECK_INTERVAL, self.maintain_connection, name="connection")
+        self.scheduler.every(DOOR_SENSOR_POLL_INTERVAL, self.poll_door_sensors, name="sensors")
+        if self.vibration_monitor is not None:
+            self.scheduler.every(VIBRATION_CHECK_INTERVAL, self.update_vibration, name="vibration")
+        self.scheduler.every(SENSOR_SAMPLING_INTERVAL, self.sensors_shield.update_sampling, name="sampling")
+        if "sgp40" in ENABLED_SENSORS:
+            self.scheduler.spawn(self.sensors_shield.run_voc_sampling(), name="voc")
+            self.scheduler.every(VOC_ALERT_CHECK_INTERVAL, self.check_air_quality, name="air-quality")
+        self.scheduler.every(TELEMETRY_CHECK_INTERVAL, self.publish_sensor_data, name="telemetry", start_delay=FIRST_PUBLISH_DELAY)
+        self.auto_close_schedule_task = self.scheduler.spawn(self.run_auto_close_schedule(), name="auto-close")
+        self.scheduler.every(STATE_SYNC_CHECK_INTERVAL, self.check_state_sync, name="state-sync")
+        self.scheduler.every(INDICATOR_UPDATE_INTERVAL, self.update_status_indicators, name="indicators")
+        self.scheduler.every(1, self.logger.update, name="logger")
+        self.scheduler.every(HISTORY_RECORD_INTERVAL, self.record_history, name="history", start_delay=FIRST_PUBLISH_DELAY)
+        self.scheduler.every(TELEMETRY_QUEUE_REPLAY_INTERVAL, self.replay_queued_telemetry, name="telemetry-queue")
+        self.scheduler.every(DIAGNOSTICS_PUBLISH_INTERVAL, self.publish_diagnostics, name="diagnostics", start_delay=DIAGNOSTICS_PUBLISH_INTERVAL)
+
+    def report_boot_times(self):
+        summary = self.boot_profiler.get_summary()
+        log.info("Boot times: %s", summary)
+        self.boot_profiler.save(f"/sd/{BOOT_TIMES_FILE}", BOOT_TIMES_HISTORY_SIZE, label=self.sensors_shield.get_date_time())
+        self.boot_times_summary = summary
+        self.publish_boot_times()
+
+    # The summary waits until we are connected, the board often boots offline
+    def publish_boot_times(self):
+        if self.boot_times_summary is None or not self.connection.is_connected():
             return
+        if self.publish_value(boot_time_feed, self.boot_times_summary):
+            self.boot_times_summary = None
+
+    def loop(self):
+        # Runs every task that is due, then sleeps until the next one is.
+        self.scheduler.tick()
+
+    # The connection objects are owned by the connection manager, which may
+    # rebuild them while recovering from a failure.
+    @property
+    def mqtt_client(self):
+        return self.connection.mqtt_client
 
-        # Publish data every x seconds
-        current_time = time.monotonic()
-        if (current_time - self.last_published_time) >= PUBLISH_TIME_INTERVAL:
-            print("Time to publish events")
-            self.publish_sensor_data()
+    @property
+    def pool(self):
+        return self.connection.pool
 
-        # Check the status of the door sensors
-        self.check_garage_safety_sensor_status()
+    @property
+    def ssl_context(self):
+        return self.connection.ssl_context
+
+    def service_mqtt(self):
+        if not self.connection.is_connected():
+            return
 
-        # Check if the garage doors are opened past the designated time and try to automatically close them
-        if not self.is_automatically_closing_garage_doors and self.can_close_doors_automatically():
-            self.close_garage_doors_if_necessary()
-        
-    def set_default_values(self):
         try:
-            self.adafruit_io_helper = AdafruitIOHelper(aio_key, self.pool, self.ssl_context)
-            if self.adafruit_io_helper.get_last_value_for_feed(auto_close_doors_feed) == "ON": 
-                self.enable_close_doors_automatically = True
-            else: 
-                self.enable_close_doors_automatically = False
-        except:
-            print("Issue setting default values")
-            pass
+            self.mqtt_client.loop()
+        except Exception as e:
+            log.warning("Failed to get data, retrying: %s", e)
+            self.log_to_sd_card("Failed while running the mqtt_client_loop() inside loop() function")
+            self.learning_shield.play_pattern(Indicator.red, "connection", CONNECTION_ERROR_PATTERN)
+            self.connection.report_failure()
+
+    def maintain_connection(self):
+        if self.connection.update():
+            self.log_to_sd_card("Recovered the connection without a reboot")
+            self.learning_shield.stop_pattern(Indicator.red, "connection")
+        self.publish_boot_times()
+
+    def run_auto_close_schedule(self):
+        # Sleeps until the next auto close deadline, the RTC is only read when we wake up.
+        # A deadline missed while rebooting fires right away, so give adafruit.io a
+        # chance to tell us whether auto close is enabled first.
+        yield STATE_SYNC_TIMEOUT
+        # doors that are due, kept until closing them was started without an error
+        due_doors = []
+        while True:
+            # An error (the RTC or the SD card) must not end the task, auto close
+            # would be gone until the next reboot
+            try:
+                now = time.monotonic()
+                now_seconds = self.sensors_shield.clock.now_seconds()
+                if self.auto_close_schedule.needs_reschedule(now):
+                    self.auto_close_schedule.reschedule(now_seconds, now)
+
+                for name in self.auto_close_schedule.pop_due_doors(now_seconds, now):
+                    if name not in due_doors:
+                        due_doors.append(name)
+                # so a reboot doesn't fire the same occurrence again
+                self.state_sync.set(AUTO_CLOSE_STATE_KEY, self.auto_close_schedule.get_last_fired())
+                if due_doors:
+                    self.close_garage_doors_if_necessary(due_doors)
+                    due_doors = []
+                delay = max(0, self.auto_close_schedule.get_next_deadline(now) - now)
+            except Exception as e:
+                log.error("Auto close schedule failed, retrying in %ds: %s", AUTO_CLOSE_RETRY_INTERVAL, e)
+                delay = AUTO_CLOSE_RETRY_INTERVAL
+            yield delay
 
     def toggle_relay(self, relay, shouldBuzz):
-        self.relay_shield.toggle_relay(relay)
+        # The relay is released by the "relays" task, we don't wait for it here
+        if not self.relay_shield.pulse_relay(relay):
+            log.info("Relay %d was triggered too recently, ignoring", relay)
+            return False
 
-        self.pixel[0] = (0, 0, 255)
-        self.learning_shield.turn_led_on(LED.yellow)
+        # flash the NeoPixel and the yellow LED for as long as the relay is energized
+        self.learning_shield.play_pattern(Indicator.pixel, "command", COMMAND_PIXEL_PATTERN)
+        self.learning_shield.play_pattern(Indicator.yellow, "command", COMMAND_LED_PATTERN)
 
         if shouldBuzz:
-            self.learning_shield.beep()
+            self.learning_shield.play_pattern(Indicator.buzzer, "command", COMMAND_BEEP_PATTERN)
+        return True
+
+    def open_or_close_door(self, door, shouldBuzz = False):
+        self.learning_shield.play_pattern(Indicator.green, "command", COMMAND_LED_PATTERN)
+        if self.toggle_relay(door.relay, shouldBuzz):
+            # the door's sensor has to confirm it moved
+            door.start_travel(time.monotonic())
 
-    def open_or_close_door(self, relay, shouldBuzz = False):
-        self.learning_shield.turn_led_on(LED.green)
-        self.toggle_relay(relay, shouldBuzz)
+    # Called by a door that didn't reach its position in time
+    def retry_door(self, door):
+        self.log_to_sd_card(f"{door.name} didn't move, trying again")
+        self.toggle_relay(door.relay, False)
+
+    def relay_energized(self, relay):
+        self.latency_monitor.mark(Latency_Stage.relay)
 
     def reset_status(self):
-        self.learning_shield.turn_led_off(LED.yellow)
-        self.learning_shield.turn_led_off(LED.red)
-        self.learning_shield.turn_led_off(LED.green)
+        # the command indicators turn themselves off when their pattern is over
+        self.latency_monitor.mark(Latency_Stage.reset)
 
-        self.pixel[0] = (0, 0, 0)
-        self.relay_shield.reset()
+    def set_pixel(self, color):
+        self.pixel[0] = color
 
     def connect_to_wifi(self):
         try:
-            print("Connecting to %s" % secrets["ssid"])
-            wifi.radio.connect(secrets["ssid"], secrets["password"])
-            print("Connected to %s!" % secrets["ssid"])
-            print("my IP addr:", wifi.radio.ipv4_address)
-        except:
-            print("Error connnecting to Wifi")
+            self.connection.connect_wifi()
+        except Exception as e:
+            log.warning("Error connnecting to Wifi: %s", e)
             self.log_to_sd_card("Error connnecting to Wifi")
-            self.reset_status()
-            self.learning_shield.turn_led_on(LED.red)
-            time.sleep(60)
-            self.reconnect()
-            pass
+            self.learning_shield.play_pattern(Indicator.red, "connection", CONNECTION_ERROR_PATTERN)
+            # the connection task will keep retrying in the background
+            self.connection.report_failure(Connection_Layer.wifi)
 
     def reconnect(self):
-        print("Reconnecting  - Performing soft reboot")
-        # Let's soft reboot the board to clear everything out and prevent error with socket.
+        log.warning("Reconnecting  - Performing soft reboot")
+        # Last resort once the connection manager gave up, soft reboot the board
+        # to clear everything out and prevent error with socket.
         self.log_to_sd_card("Performing soft reboot to recover from broken connections.")
+        # keep a record of the heap in case we ran out of memory
+        self.log_to_sd_card("Heap: " + self.memory_monitor.get_summary())
+        # make sure the buffered log messages and the state are written before we reboot
+        self.state_sync.flush()
+        self.logger.close()
         supervisor.reload()
-        
-
-    def connect_to_mqtt(self):
-        print("Connecting to MQTT Server")
-
-        # Create a socket pool
-        self.pool = socketpool.SocketPool(wifi.radio)
-        self.ssl_context = ssl.create_default_context()
 
+    def create_mqtt_client(self, pool, ssl_context):
         # Set up a MiniMQTT Client
-        self.mqtt_client = MQTT.MQTT(
+        mqtt_client = MQTT.MQTT(
             broker=secrets["broker"],
             port=secrets["port"],
             username=secrets["aio_username"],
             password=secrets["aio_key"],
-            socket_pool=self.pool,
-            ssl_context=self.ssl_context,
+            socket_pool=pool,
+            ssl_context=ssl_context,
         )
 
         # Setup the callback methods above
-        self.mqtt_client.on_connect = self.connected
-        self.mqtt_client.on_disconnect = self.disconnected
-        self.mqtt_client.on_message = self.message
-        self.mqtt_client.on_subscribe = self.subscribe
+        mqtt_client.on_connect = self.connected
+        mqtt_client.on_disconnect = self.disconnected
+        mqtt_client.on_message = self.message
+        mqtt_client.on_subscribe = self.subscribe
+        return mqtt_client
 
-        # Connect the client to the MQTT broker.
-        print("Connecting to Adafruit IO...")
+    def connect_to_mqtt(self):
+        if self.connection.failed_layer is not None:
+            # no point trying, the connection task will bring MQTT up with the Wi-Fi
+            return
+
+        log.info("Connecting to MQTT Server")
         try:
-            self.mqtt_client.connect()
+            self.connection.connect_mqtt()
         except Exception as e:
-            print(e)
+            log.warning("Error connecting to MQTT: %s", e)
             self.log_to_sd_card("Something went wrong connecting to MQTT server")
-            time.sleep(60)
-            self.reconnect()
-            # failing gracefully for now since we can try again in the next cycle
-            pass
+            # failing gracefully for now since the connection task will try again
+            self.connection.report_failure(Connection_Layer.mqtt)
 
     def publish_sensor_data(self):
-        brightness = self.sensors_shield.get_light_sensor_value()
-        temp = self.sensors_shield.get_temperature()
-        humidity = self.sensors_shield.get_humidity()
-        hpa = self.sensors_shield.get_barometric_pressure()
-        raw_gas = self.sensors_shield.get_raw_gass_value()
+        now = time.monotonic()
+        # values is what gets published, reported keeps the numeric value of each
+        # published feed for the deadband checks
+        values = {}
+        reported = {}
+
+        for door in self.doors:
+            value = door.state
+            if self.feed_reporter.should_report(door.status_feed, value, now):
+                values[door.status_feed] = reported[door.status_feed] = value
+
+        self.add_sensor_value(values, reported, brightness_feed, "brightness", now)
+        self.add_sensor_value(values, reported, temperature_feed, "temperature", now)
+        self.add_sensor_value(values, reported, humidity_feed, "humidity", now)
+        self.add_sensor_value(values, reported, hpa_feed, "pressure", now)
+        self.add_sensor_value(values, reported, voc_index_feed, "voc", now)
+
+        if not values:
+            # nothing changed enough to be worth sending
+            return
+
+        if not self.connection.is_connected():
+            # keep the values on the SD card, they are sent once we are connected again
+            self.queue_telemetry(reported)
+        else:
+            log.debug("Sending values")
+            if not self.publish_feeds(values):
+                self.log_to_sd_card("Error while sending data to MQTT Broker")
+                self.queue_telemetry(reported)
+
+        # queued values count as reported, the deadbands apply to them as well
+        for feed, value in reported.items():
+            self.feed_reporter.mark_reported(feed, value, now)
+
+    def add_sensor_value(self, values, reported, feed, sensor_name, now):
+        # Publish the windowed average from the sampling engine
+        stats = self.sensors_shield.get_sensor_stats(sensor_name)
+        if stats is None:
+            # no samples yet
+            return
+
+        mean, minimum, maximum = stats
+        if not self.feed_reporter.should_report(feed, mean, now):
+            return
+
+        reported[feed] = mean
+        value_format = FEED_VALUE_FORMATS.get(feed)
+        if value_format is not None:
+            mean, minimum, maximum = value_format % mean, value_format % minimum, value_format % maximum
+
+        values[feed] = mean
+        if PUBLISH_MIN_MAX:
+            values[feed + "-min"] = minimum
+            values[feed + "-max"] = maximum
+
+    def publish_feeds(self, values):
+        # values is a dictionary of {feed_topic: value}
+        if USE_GROUP_PUBLISH:
+            try:
+                self.publish_group(values)
+                return True
+            except Exception as e:
+                log.warning("Group publish failed, falling back to individual feeds: %s", e)
 
-        print("Sending values")
         try:
-            self.mqtt_client.publish(temperature_feed, temp)
-            self.mqtt_client.publish(humidity_feed, humidity)
-            self.mqtt_client.publish(hpa_feed, hpa)
-            self.mqtt_client.publish(brightness_feed, brightness)
-            self.mqtt_client.publish(raw_gas_feed, raw_gas)
-        except:
-            print("Something went wrong sending data to MQTT")
-            self.log_to_sd_card("Error while sending data to MQTT Broker")
-            # failing gracefully for now since we can try again in the next cycle
-            return 
+            for feed, value in values.items():
+                self.mqtt_client.publish(feed, value)
+        except Exception as e:
+            log.warning("Something went wrong sending data to MQTT: %s", e)
+            return False
+
+        return True
+
+    def publish_group(self, values, created_at = None):
+        # Adafruit IO group payload: {"feeds": {"temperature": 72.5, "humidity": 40, ...}}
+        feeds = {}
+        for feed, value in values.items():
+            feeds[get_feed_key(feed)] = value
+
+        payload = {"feeds": feeds}
+        if created_at is not None:
+            payload["created_at"] = created_at
+        self.mqtt_client.publish(garage_group_feed, json.dumps(payload))
+
+    def queue_telemetry(self, values):
+        # values is a dictionary of {feed_topic: numeric value}
+        timestamp = self.sensors_shield.clock.now_seconds()
+        for feed, value in values.items():
+            self.telemetry_queue.push(feed, value, timestamp)
+
+    def replay_queued_telemetry(self):
+        if len(self.telemetry_queue) == 0 or not self.connection.is_connected():
+            return
+
+        # Send the oldest records, one group message per timestamp (a message has
+        # a single created_at), for as long as the replay credit lasts.
+        try:
+            records = self.telemetry_queue.peek(TELEMETRY_QUEUE_REPLAY_BATCH)
+        except Exception as e:
+            log.error("Error reading the telemetry queue: %s", e)
+            return
+
+        # a message holds at most one value per queued feed, it always fits eventually
+        self.telemetry_replay_credit = min(self.telemetry_replay_credit + TELEMETRY_QUEUE_REPLAY_VALUES,
+                                           max(2 * TELEMETRY_QUEUE_REPLAY_VALUES, len(QUEUED_FEEDS)))
+        sent = 0
+        consumed = 0 # records published or skipped, they are committed by position
+        while consumed < len(records):
+            timestamp = records[consumed][0]
+            values = {}
+            end = consumed
+            while end < len(records) and records[end][0] == timestamp:
+                feed, value = records[end][1], records[end][2]
+                # None: the feed was removed from QUEUED_FEEDS, drop the record
+                if feed is not None:
+                    value_format = FEED_VALUE_FORMATS.get(feed)
+                    values[feed] = value_format % value if value_format is not None else value
+                end += 1
+            if len(values) > self.telemetry_replay_credit:
+                break
+
+            if values:
+                try:
+                    self.publish_group(values, created_at=self.get_iso_time(timestamp))
+                except Exception as e:
+                    log.warning("Failed to replay the queued telemetry, will try again: %s", e)
+                    break
+                sent += len(values)
+                self.telemetry_replay_credit -= len(values)
+            consumed = end
+
+        if consumed > 0:
+            self.telemetry_queue.commit(consumed)
+            log.info("Replayed %d queued values, %d records left", sent, len(self.telemetry_queue))
+
+    def check_air_quality(self):
+        index = self.sensors_shield.get_latest_sample("voc")
+        if index is not None:
+            self.voc_alert.update(index)
+
+    def voc_alert_changed(self, alert, is_active):
+        if is_active:
+            self.log_to_sd_card(f"VOC index above {alert.threshold} for {alert.sustain_time}s (peak {alert.peak_index:.0f}), ventilating")
+            self.learning_shield.play_pattern(Indicator.buzzer, "voc", VOC_ALERT_BEEP_PATTERN)
+            self.learning_shield.play_pattern(Indicator.yellow, "voc", VOC_ALERT_LED_PATTERN)
+        else:
+            self.log_to_sd_card(f"VOC index back below {alert.clear_threshold} (peak {alert.peak_index:.0f})")
+            self.learning_shield.stop_pattern(Indicator.yellow, "voc")
 
-        self.publish_door_status(door1status_feed, int(door1_magnetic_sensor.value))
-        self.publish_door_status(door2status_feed, int(door2_magnetic_sensor.value))
+        if VENTILATION_RELAY is not None:
+            if is_active:
+                self.relay_shield.energize_relay(VENTILATION_RELAY)
+            else:
+                self.relay_shield.release_relay(VENTILATION_RELAY)
+        self.publish_value(voc_alert_feed, 1 if is_active else 0)
+
+    def record_history(self):
+        # the windowed averages, same as what gets published
+        values = []
+        for name in HISTORY_FIELDS:
+            stats = self.sensors_shield.get_sensor_stats(name)
+            values.append(stats[0] if stats is not None else NAN)
+        door_states = [door.state for door in self.doors]
+        self.history.append(self.sensors_shield.clock.now_seconds(), values, door_states)
+
+    # 2021-04-07T19:46:00Z
+    def get_iso_time(self, timestamp):
+        t = time.localtime(timestamp + RTC_UTC_OFFSET_HOURS * 3600)
+        return "{:04}-{:02}-{:02}T{:02}:{:02}:{:02}Z".format(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
 
-        # save the last time we published data
-        current_time = time.monotonic()
-        self.last_published_time = current_time
-    
     def publish_door_status(self, door_feed, value):
-        print("publishing door status:", door_feed)
+        log.debug("publishing door status: %s", door_feed)
         try:
             self.mqtt_client.publish(door_feed, value)
-        except:
-            print("Something went wrong sending data to MQTT")
+        except Exception as e:
+            log.warning("Something went wrong sending data to MQTT: %s", e)
             # failing gracefully for now since we can try again in the next cycle
-            pass
+            return False
+        return True
+
+    def publish_diagnostics(self):
+        summary = self.memory_monitor.get_summary()
+        log.info("Heap: %s", summary)
+        self.publish_value(diagnostics_feed, "heap " + summary)
+        self.memory_monitor.reset()
+
+        if self.vibration_monitor is not None:
+            summary = self.vibration_monitor.get_summary()
+            log.info("Vibration: %s", summary)
+            self.publish_value(diagnostics_feed, "vibration " + summary)
+            self.vibration_monitor.reset_stats()
+
+        # travel times (seconds) since boot
+        for door in self.doors:
+            if door.travel_times.count > 0 or door.fault_count > 0:
+                summary = door.get_travel_summary()
+                log.info("%s travel: %s", door.name, summary)
+                self.publish_value(diagnostics_feed, door.name + " travel " + summary)
+
+        if not self.latency_monitor.has_samples():
+            return
+
+        summary = self.latency_monitor.get_summary()
+        log.info("Command latency (ms): %s", summary)
+        self.publish_value(diagnostics_feed, summary)
+        # every report covers the commands since the previous one
+        self.latency_monitor.reset()
+
+    def publish_value(self, feed, value):
+        try:
+            self.mqtt_client.publish(feed, value)
+            return True
+        except Exception as e:
+            log.warning("Something went wrong sending data to MQTT: %s", e)
+            return False
 
     def connected(self, client, userdata, flags, rc):
         # This function will be called when the client is connected
         # successfully to the broker.
-        print("Connected to Adafruit IO!")
+        log.info("Connected to Adafruit IO!")
+
         # Subscribe to the relay feeds
-        client.subscribe(door1button_feed)
-        client.subscribe(door2button_feed)
-        client.subscribe(relay3_feed)
-        client.subscribe(relay4_feed)
-        client.subscribe(auto_close_doors_feed)
+        for topic in self.topic_handlers:
+            client.subscribe(topic)
+
+        # and ask for the settings we may have missed while offline
+        self.state_sync.request(client, self.state_handlers)
+
+    def create_topic_handlers(self):
+        # Incoming messages are routed with a single dictionary lookup, no
+        # matter how many doors and feeds there are.
+        topic_handlers = {
+            relay3_feed: (self.handle_spare_relay_message, "relay3"),
+            relay4_feed: (self.handle_spare_relay_message, "relay4"),
+            auto_close_doors_feed: (self.handle_auto_close_message, None),
+        }
+        for door in self.doors:
+            topic_handlers[door.button_feed] = (self.handle_door_command, door)
+        return topic_handlers
+
+    # The feeds synced with adafruit.io, topic -> (function restoring the value, argument)
+    def create_state_handlers(self):
+        state_handlers = {
+            auto_close_doors_feed: (self.set_auto_close, None),
+        }
+        return state_handlers
+
+    def restore_state(self, topic, value):
+        handler = self.state_handlers.get(topic)
+        if handler is not None:
+            handler[0](handler[1], value)
+
+    def check_state_sync(self):
+        for topic in self.state_sync.update():
+            log.warning("No answer for %s, using the saved value %s", topic, self.state_sync.get(topic))
 
     def disconnected(self, client, userdata, rc):
         # This method is called when the client is disconnected
-        print("Disconnected from Adafruit IO!")
+        log.info("Disconnected from Adafruit IO!")
 
     def subscribe(self, client, userdata, topic, granted_qos):
         # This method is called when the client subscribes to a new feed.
-        print("Subscribed to {0}".format(topic))
+        log.debug("Subscribed to %s", topic)
 
     def message(self, client, topic, message):
         # This method is called when a topic the client is subscribed to
         # has a new message.
-        print("New message on topic {0}: {1}".format(topic, message))
-        if topic == door1button_feed:
-            if message == "OPEN":
-                print("Turning relay #1 ON")
-                self.open_or_close_door(Relay.one, shouldBuzz=False)
-            elif message == "CLOSE":
-                print("Turning relay #1 OFF")
-                self.open_or_close_door(Relay.one, shouldBuzz=False)
-        elif topic == door2button_feed:
-            if message == "OPEN":
-                print("Turning relay #2 ON")
-                self.open_or_close_door(Relay.two, shouldBuzz=False)
-            elif message == "CLOSE":
-                print("Turning relay #2 OFF")
-                self.open_or_close_door(Relay.two, shouldBuzz=False)
-        elif topic == relay3_feed:
-            print("Got a message for relay3", message)
-        elif topic == relay4_feed:
-            print("Got a message for relay4", message)
-        elif topic == auto_close_doors_feed:
-            if message == "ON":
-                self.enable_close_doors_automatically = True
-            else:
-                self.enable_close_doors_automatically = False
+        log.debug("New message on topic %s: %s", topic, message)
+        if self.state_sync.is_pending(topic):
+            # The answer to our /get request. It goes through the same handler as
+            # a change made on the dashboard, the synced feeds only set a value.
+            self.state_sync.received(topic, message)
+
+        self.latency_monitor.mark_received()
+        handler = self.topic_handlers.get(topic)
+        if handler is not None:
+            handler[0](handler[1], message)
         else:
-            print("Got a message that doesn't match any topics")
+            log.warning("Got a message that doesn't match any topics: %s", topic)
 
         self.reset_status()
 
+    def handle_door_command(self, door, message):
+        self.latency_monitor.mark(Latency_Stage.dispatch)
+        if message == "OPEN":
+            log.info("Opening %s", door.name)
+            self.open_or_close_door(door, shouldBuzz=False)
+        elif message == "CLOSE":
+            log.info("Closing %s", door.name)
+            self.open_or_close_door(door, shouldBuzz=False)
+
+    def handle_spare_relay_message(self, relay_name, message):
+        log.info("Got a message for %s: %s", relay_name, message)
+
+    def handle_auto_close_message(self, argument, message):
+        self.set_auto_close(argument, message)
+        self.state_sync.set(auto_close_doors_feed, message)
+
+    def set_auto_close(self, argument, message):
+        if message == "ON":
+            self.enable_close_doors_automatically = True
+        else:
+            self.enable_close_doors_automatically = False
+
     def log_to_sd_card(self, message):
-        try:
-            # open file for append
-            with open(f"/sd/{LOG_FILE}", "a") as f:
-                date_time = self.sensors_shield.get_date_time()
-                log_string = f"{date_time} - {message}\n"
-                f.write(log_string)
-                print(log_string)
-            # file is saved
-            time.sleep(1)
-        except:
-            print("Error logging to SD Card")
-            pass
-
-    def can_close_doors_automatically(self):
-        now = time.monotonic()
-        if now - self.last_auto_close_time >= AUTO_CLOSE_WAIT_TIME_IN_MINUTES:
-            return True
-        
-        return False
+        # The message is only copied to the log buffer here, the SD card is
+        # written in batches by the logger task.
+        log.info(message)
+        self.logger.log(message)
 
-    def close_garage_doors_if_necessary(self):
+    # Called by the auto close schedule with the names of the doors that are due
+    def close_garage_doors_if_necessary(self, door_names):
         if not self.enable_close_doors_automatically:
             return
 
-        hour, minutes = self.sensors_shield.get_current_time_as_tuple()
+        if self.is_automatically_closing_garage_doors:
+            log.info("Already closing the garage doors, skipping %s", door_names)
+            return
 
-        if hour == AUTO_CLOSE_DOORS_AFTER_HOUR and minutes >= AUTO_CLOSE_DOORS_AFTER_MINUTES:
-            print("We should try to close the garage automatically")
-            self.is_automatically_closing_garage_doors = True
-            self.automatically_closed_datetime_tuple = self.sensors_shield.get_date_tuple() + self.sensors_shield.get_current_time_as_tuple()
-            self.last_auto_close_time = time.monotonic()
+        log.info("We should try to close the garage automatically")
+        # read the time first, the flag must not stay set if that fails
+        self.automatically_closed_datetime_tuple = self.sensors_shield.get_date_tuple() + self.sensors_shield.get_current_time_as_tuple()
+        self.is_automatically_closing_garage_doors = True
 
+        # The close sequence takes ~30 seconds, run it as a coroutine so the
+        # MQTT loop keeps running in the meantime.
+        self.scheduler.spawn(self.auto_close_doors(door_names), name="auto-close-sequence")
+
+    def auto_close_doors(self, door_names):
+        try:
             self.log_to_sd_card("About to close garage doors automatically")
 
             # First check the door status to see which door is opened
-            door_opened_relays = []
-            if self.door1_is_opened:
-                print("Door one is opened, adding it to the array")
-                door_opened_relays.append(Relay.one)
-            
-            if self.door2_is_opened:
-                print("Door two is opened, adding it to the array")
-                door_opened_relays.append(Relay.two)
-
-            print(door_opened_relays)
-            if len(door_opened_relays) > 0:
+            opened_doors = []
+            for door in self.doors:
+                if door.name in door_names and door.is_opened:
+                    log.debug("%s is opened, adding it to the array", door.name)
+                    opened_doors.append(door)
+
+            if len(opened_doors) > 0:
                 # We have open door(S)
-                print("We have doors opened, let's try to close them.")
+                log.info("We have doors opened, let's try to close them.")
 
                 # Beep a few times before sending the close command
-                self.learning_shield.beep_by(5, 1.0)
-                time.sleep(15)
+                self.learning_shield.play_pattern(Indicator.buzzer, "auto-close", AUTO_CLOSE_WARNING_PATTERN)
+                yield AUTO_CLOSE_WARNING_PATTERN.get_duration()
 
-                # Run the mqtt loop to make sure we don't have new events before closing the garage. 
-                # This is an opportunity to stop this process from adafruit.io dashboard.
-                try:
-                    self.mqtt_client.loop()
-                except Exception as e:
-                    print("Failed to run the mqtt_client_loop()\n", e)
-                    self.log_to_sd_card("Failed to run the mqtt_client_loop() from close_garage_doors_if_necessary()")
-                    pass
+                # The MQTT task keeps running while we wait. This is an opportunity
+                # to stop this process from adafruit.io dashboard.
+                yield 15
 
                 if not self.enable_close_doors_automatically:
                     return
 
-                time.sleep(5)
-                self.learning_shield.beep_by(10, 0.10)
-
-                time.sleep(1)
-                # We are good to close the doors now
-                for relay in door_opened_relays:
-                    self.log_to_sd_card(f"Closing Door #{relay}")
-                    self.learning_shield.beep_by(3, 0.20)
-                    self.open_or_close_door(relay)
-                    time.sleep(5)
-                
+                yield 5
+                self.learning_shield.play_pattern(Indicator.buzzer, "auto-close", AUTO_CLOSE_FINAL_WARNING_PATTERN)
+                yield AUTO_CLOSE_FINAL_WARNING_PATTERN.get_duration()
+
+                yield 1
+                # We are good to close the doors now, all of them at once
+                self.learning_shield.play_pattern(Indicator.buzzer, "auto-close", AUTO_CLOSE_CLOSING_PATTERN)
+                yield AUTO_CLOSE_CLOSING_PATTERN.get_duration()
+                for door in opened_doors:
+                    self.log_to_sd_card(f"Closing {door.name}")
+                    self.open_or_close_door(door)
+
                 self.reset_status()
-                self.is_automatically_closing_garage_doors = False
-
-            # Check door status to confirm is closed
-            self.check_garage_safety_sensor_status()
-
-            # Publish door status to adafruit.io dashboard
-            self.publish_sensor_data()
-        
-    def check_garage_safety_sensor_status(self):
-        if door1_magnetic_sensor.value:
-            self.door1_is_opened = True
-            self.learning_shield.turn_led_on(LED.red)
-            self.learning_shield.turn_led_off(LED.green)
-            time.sleep(1)
+
+                # Wait for the sensors to confirm the doors closed, the doors retry
+                # and time out on their own and report to adafruit.io as they go.
+                while self.is_any_door_moving(opened_doors):
+                    yield 1
+                for door in opened_doors:
+                    if door.state != Door_State.closed:
+                        self.log_to_sd_card(f"{door.name} didn't close, it is {STATE_NAMES[door.state]}")
+        finally:
+            # stop the warning beeps if the sequence was cancelled
+            self.learning_shield.stop_pattern(Indicator.buzzer, "auto-close")
+            self.is_automatically_closing_garage_doors = False
+
+    def poll_door_sensors(self):
+        now = time.monotonic()
+        for door in self.doors:
+            door.update(now)
+
+    def door_status_changed(self, door, is_opened):
+        # Called by the door on a debounced edge, publish right away
+        # instead of waiting for the next heartbeat.
+        log.debug("Door sensor changed: %s %s", door.name, is_opened)
+        # the "opened for too long" deadlines start (or stop) now
+        if is_opened:
+            self.auto_close_schedule.door_opened(door.name)
         else:
-            self.door1_is_opened = False
-            self.learning_shield.turn_led_off(LED.red)
-            self.learning_shield.turn_led_on(LED.green)
-            time.sleep(1)
-
-        # Check Door #2
-        if door2_magnetic_sensor.value:
-            self.door2_is_opened = True
-            self.learning_shield.turn_led_on(LED.yellow)
-            time.sleep(1)
+            self.auto_close_schedule.door_closed(door.name)
+        self.scheduler.wake(self.auto_close_schedule_task)
+
+    def door_state_changed(self, door, state):
+        # Moving, confirmed or faulty, publish right away instead of waiting for
+        # the next heartbeat.
+        log.info("Door status changed: %s %s", door.name, STATE_NAMES[state])
+        if state == Door_State.fault:
+            self.log_to_sd_card(f"{door.name} didn't reach its position after {door.max_retries + 1} tries")
+            self.learning_shield.play_pattern(Indicator.red, "fault-" + door.name, DOOR_FAULT_PATTERN)
         else:
-            self.door2_is_opened = False
-            self.learning_shield.turn_led_off(LED.yellow)
-            time.sleep(1)
+            self.learning_shield.stop_pattern(Indicator.red, "fault-" + door.name)
+
+        if not self.publish_door_status(door.status_feed, state):
+            self.queue_telemetry({door.status_feed: state})
+        # a queued state counts as reported too, or the next telemetry pass queues it again
+        self.feed_reporter.mark_reported(door.status_feed, state, time.monotonic())
+
+    def start_vibration_monitor(self):
+        try:
+            self.vibration_monitor = self.sensors_shield.create_vibration_monitor()
+        except Exception as e:
+            log.warning("Error starting the vibration monitor: %s", e)
+            self.log_to_sd_card("Error starting the vibration monitor")
+        if self.vibration_monitor is not None:
+            self.vibration_monitor.on_change = self.door_motor_changed
+
+    def update_vibration(self):
+        now = time.monotonic()
+        monitor = self.vibration_monitor
+        monitor.update(now)
+        if monitor.is_running:
+            return
+        for door in self.doors:
+            if not door.is_moving() or now - door.travel_started_time < DOOR_MOTOR_START_TIMEOUT:
+                continue
+            if monitor.started_time is None or monitor.started_time < door.travel_started_time:
+                log.info("%s motor didn't start", door.name)
+                door.shorten_travel(now)
+
+    def door_motor_changed(self, monitor, is_running):
+        if is_running:
+            log.info("Door motor running")
+            if not self.is_any_door_moving(self.doors):
+                # the wall button or a remote, the switch will tell which door
+                self.log_to_sd_card("A door motor started without a command from the dashboard")
+            return
+
+        log.info("Door motor stopped")
+        # a moving door whose motor stopped is jammed (or the opener reversed), unless
+        # its switch confirms the move right away
+        deadline = time.monotonic() + DOOR_MOTOR_STOP_GRACE
+        for door in self.doors:
+            door.shorten_travel(deadline)
+
+    def is_any_door_moving(self, doors):
+        for door in doors:
+            if door.is_moving():
+                return True
+        return False
+
+    def update_status_indicators(self):
+        # Each door keeps its status LED on while opened (and its closed LED while closed)
+        for door in self.doors:
+            self.show_door_status(door.status_led, door.name, door.is_opened)
+            self.show_door_status(door.closed_led, door.name, not door.is_opened)
+
+    def show_door_status(self, led, name, is_on):
+        if led is None:
+            return
+        is_playing = self.learning_shield.is_pattern_playing(led, name)
+        if is_on and not is_playing:
+            self.learning_shield.play_pattern(led, name, DOOR_STATUS_PATTERN)
+        elif not is_on and is_playing:
+            self.learning_shield.stop_pattern(led, name)
@@ -0,0 +1,104 @@
+# ATMegaZero Latency Monitor
+#
+# Measures how long a command from the dashboard takes to reach the relays. Each
+# command is timestamped when the MQTT message is received, when message()
+# dispatches it, when the relay is energized and when reset_status() runs. The
+# latency of every stage (measured from the receipt) goes into a fixed bucket
+# histogram, so recording an event never allocates.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+from array import array
+
+# Upper bound (in milliseconds) of each histogram bucket, anything slower goes
+# into an extra overflow bucket.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Latency_Stage:
+    dispatch = 0
+    relay = 1
+    reset = 2
+    def __init__(self, stage):
+        assert stage in (self.dispatch, self.relay, self.reset)
+        self.selection = stage
+
+STAGE_NAMES = ("dispatch", "relay", "reset")
+
+# Fixed bucket histogram, the values are in the unit of `bounds` (milliseconds
+# for the latencies, seconds for the door travel times)
+class Histogram:
+    def __init__(self, bounds = LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = array("L", [0] * (len(bounds) + 1))
+        self.count = 0
+        self.max_value = 0
+
+    def add(self, value):
+        index = 0
+        bounds = self.bounds
+        while index < len(bounds) and value > bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max_value:
+            self.max_value = value
+
+    # Upper bound of the bucket holding the given percentile (0.5 for p50), the
+    # overflow bucket reports the max.
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for index in range(len(self.counts)):
+            seen += self.counts[index]
+            if seen >= target and self.counts[index] > 0:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max_value)
+                return self.max_value
+        return self.max_value
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.max_value = 0
+
+class LatencyMonitor:
+    def __init__(self, bounds = LATENCY_BUCKETS_MS):
+        self.histograms = [Histogram(bounds) for _ in STAGE_NAMES]
+        self.received_ns = 0
+        self.is_tracking = False
+
+    def mark_received(self):
+        self.received_ns = time.monotonic_ns()
+        self.is_tracking = False
+
+    # Only commands that get dispatched to a relay are tracked past the dispatch stage
+    def mark(self, stage):
+        if stage == Latency_Stage.dispatch:
+            self.is_tracking = True
+        elif not self.is_tracking:
+            return
+        latency_ms = (time.monotonic_ns() - self.received_ns) // 1000000
+        self.histograms[stage].add(latency_ms)
+        if stage == Latency_Stage.reset:
+            # reset_status() is the last step of a command
+            self.is_tracking = False
+
+    def has_samples(self):
+        return self.histograms[Latency_Stage.dispatch].count > 0
+
+    # dispatch p50=1 p95=2 max=3 | relay p50=... (milliseconds)
+    def get_summary(self):
+        parts = []
+        for index, histogram in enumerate(self.histograms):
+            parts.append("{} p50={} p95={} max={} n={}".format(
+                STAGE_NAMES[index], histogram.percentile(0.50), histogram.percentile(0.95),
+                histogram.max_value, histogram.count))
+        return " | ".join(parts)
+
+    def reset(self):
+        for histogram in self.histograms:
+            histogram.reset()
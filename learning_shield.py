@@ -6,8 +6,20 @@
 # For full documentation please visit https://atmegazero.com
 
 import board
-import time
 from digitalio import DigitalInOut, Pull
+from log import get_logger
+from pattern_sequencer import PatternSequencer
+
+# Not every board/pin has PWM, the buzzer is driven as a plain output then
+try:
+    import pwmio
+except ImportError:
+    pwmio = None
+
+BUZZER_FREQUENCY = 2000 # Hz
+BUZZER_DUTY_CYCLE = 32768 # 50%
+
+log = get_logger("learning")
 
 class LED:
     red = 0
@@ -17,9 +29,20 @@ class LED:
         assert led in (self.red, self.yellow, self.green)
         self.selection = led
 
+# The outputs driven by the pattern sequencer, the LEDs keep their LED values
+class Indicator:
+    red = LED.red
+    yellow = LED.yellow
+    green = LED.green
+    buzzer = 3
+    pixel = 4
+    def __init__(self, indicator):
+        assert indicator in (self.red, self.yellow, self.green, self.buzzer, self.pixel)
+        self.selection = indicator
+
 class ATMegaZero_Learning_Shield:
     def __init__(self, *args):
-        print("Learning Shield Initialized")
+        log.info("Learning Shield Initialized")
         # LEDs
         self.redLED = DigitalInOut(board.A0)
         self.redLED.switch_to_output()
@@ -27,13 +50,53 @@ class ATMegaZero_Learning_Shield:
         self.greenLED.switch_to_output()
         self.yellowLED = DigitalInOut(board.A1)
         self.yellowLED.switch_to_output()
-        self.buzzer = DigitalInOut(board.D6)
-        self.buzzer.switch_to_output()
+        self.buzzer = None
+        self.buzzer_pwm = None
+        if pwmio is not None:
+            try:
+                self.buzzer_pwm = pwmio.PWMOut(board.D6, frequency=BUZZER_FREQUENCY, duty_cycle=0)
+            except (ValueError, RuntimeError):
+                self.buzzer_pwm = None
+        if self.buzzer_pwm is None:
+            self.buzzer = DigitalInOut(board.D6)
+            self.buzzer.switch_to_output()
 
         # Push Button
         self.pushButton = DigitalInOut(board.D7)
         self.pushButton.switch_to_input(pull=Pull.DOWN)
 
+        # Non-blocking blink/beep patterns, call update_patterns() from the main loop
+        self.sequencer = PatternSequencer()
+        for led in (LED.red, LED.yellow, LED.green):
+            self.sequencer.add_channel(led, self._led_writer(led))
+        self.sequencer.add_channel(Indicator.buzzer, self.set_buzzer)
+
+    def _led_writer(self, led):
+        def write(is_on):
+            if is_on:
+                self.turn_led_on(led)
+            else:
+                self.turn_led_off(led)
+        return write
+
+    def play_pattern(self, indicator, name, pattern):
+        self.sequencer.play(indicator, name, pattern)
+
+    def stop_pattern(self, indicator, name):
+        self.sequencer.stop(indicator, name)
+
+    def is_pattern_playing(self, indicator, name):
+        return self.sequencer.is_playing(indicator, name)
+
+    def update_patterns(self, now = None):
+        self.sequencer.update(now)
+
+    def set_buzzer(self, is_on):
+        if self.buzzer_pwm is not None:
+            self.buzzer_pwm.duty_cycle = BUZZER_DUTY_CYCLE if is_on else 0
+        else:
+            self.buzzer.value = is_on
+
     def turn_led_on(self, led):
         if led == LED.red:
             self.redLED.value = True
@@ -49,16 +112,3 @@ class ATMegaZero_Learning_Shield:
             self.yellowLED.value = False
         elif led == LED.green:
             self.greenLED.value = False
- 
-    def beep(self):
-        self.buzzer.value = True
-        time.sleep(0.1)
-        self.buzzer.value = False
-
-    def beep_by(self, numOfBeeps, delay = 0.5):
-        for _ in range(numOfBeeps):
-            self.buzzer.value = True
-            time.sleep(delay)
-            self.buzzer.value = False
-            time.sleep(delay)
-    
\ No newline at end of file
@@ -0,0 +1,90 @@
+# ATMegaZero Log
+#
+# Leveled logging for the firmware. Every module gets its own Logger with
+# get_logger(name), they all share the level and the sinks set here. A message
+# below the level returns before doing anything, so pass the values as arguments
+# ("Humidity: %s", humidity) instead of formatting the message yourself: the
+# string is only built when the message is actually written.
+#
+# Messages are printed to the serial console, sinks (e.g. the SD card logger)
+# only receive the messages at or above their own level.
+#
+# For full documentation please visit https://atmegazero.com
+
+class Log_Level:
+    debug = 0
+    info = 1
+    warning = 2
+    error = 3
+    none = 4 # turns logging off
+    def __init__(self, level):
+        assert level in (self.debug, self.info, self.warning, self.error, self.none)
+        self.selection = level
+
+LEVEL_NAMES = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+DEFAULT_LEVEL = Log_Level.info
+
+_level = DEFAULT_LEVEL
+_sinks = [] # (level, write(line))
+_loggers = {}
+
+def set_level(level):
+    global _level
+    _level = level
+
+def get_level():
+    return _level
+
+# write is called with the formatted line for every message at or above level
+def add_sink(write, level = Log_Level.warning):
+    _sinks.append((level, write))
+
+def remove_sink(write):
+    for sink in _sinks:
+        if sink[1] == write:
+            _sinks.remove(sink)
+            return
+
+def get_logger(name):
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = Logger(name)
+        _loggers[name] = logger
+    return logger
+
+class Logger:
+    def __init__(self, name):
+        self.name = name
+
+    def is_enabled(self, level):
+        return level >= _level
+
+    def debug(self, message, *args):
+        if Log_Level.debug >= _level:
+            self._write(Log_Level.debug, message, args)
+
+    def info(self, message, *args):
+        if Log_Level.info >= _level:
+            self._write(Log_Level.info, message, args)
+
+    def warning(self, message, *args):
+        if Log_Level.warning >= _level:
+            self._write(Log_Level.warning, message, args)
+
+    def error(self, message, *args):
+        if Log_Level.error >= _level:
+            self._write(Log_Level.error, message, args)
+
+    def _write(self, level, message, args):
+        if args:
+            message = message % args
+        line = "{} {}: {}".format(LEVEL_NAMES[level], self.name, message)
+        print(line)
+        for sink_level, write in _sinks:
+            if level >= sink_level:
+                # logging is used from error handlers, a broken sink must not raise there
+                try:
+                    write(line)
+                except Exception as e:
+                    print("Error writing to a log sink:", e)
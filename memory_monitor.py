@@ -0,0 +1,85 @@
+# ATMegaZero Memory Monitor
+#
+# Heap instrumentation. The scheduler reports how many bytes every task
+# allocates and how much heap is left after it ran, so we know which stage of
+# the loop is eating the memory and how close we get to running out (the low
+# water mark). It can also run gc.collect() at idle points on a schedule, so a
+# collection doesn't land in the middle of a command.
+#
+# For full documentation please visit https://atmegazero.com
+
+import gc
+import time
+
+class MemoryMonitor:
+    def __init__(self, gc_interval = 0, gc_min_free = 0, gc_min_idle_time = 0.005, gc_min_spacing = 1):
+        self.gc_interval = gc_interval # seconds between collections, 0 disables them
+        self.gc_min_free = gc_min_free # also collect when the free heap drops below this (bytes)
+        # seconds between low memory collections, the heap can stay low for a while
+        # and collecting on every idle pass would leave no time for the loop
+        self.gc_min_spacing = gc_min_spacing
+        self.gc_min_idle_time = gc_min_idle_time # only collect when idle for at least this long
+        self.last_gc_time = time.monotonic()
+        self.gc_count = 0
+        self.gc_time_ns = 0 # total time spent collecting
+
+        self.low_water = gc.mem_free()
+        # stage -> [runs, lowest free heap after the stage, most bytes allocated in one run]
+        self.stages = {}
+
+    # Call begin() before the stage runs and end() with its result afterwards
+    def begin(self):
+        return gc.mem_alloc()
+
+    def end(self, stage, started_alloc):
+        free = gc.mem_free()
+        # a collection in the middle of the stage makes the difference meaningless
+        allocated = max(0, gc.mem_alloc() - started_alloc)
+        if free < self.low_water:
+            self.low_water = free
+
+        stats = self.stages.get(stage)
+        if stats is None:
+            self.stages[stage] = [1, free, allocated]
+            return
+        stats[0] += 1
+        if free < stats[1]:
+            stats[1] = free
+        if allocated > stats[2]:
+            stats[2] = allocated
+
+    # Runs gc.collect() if one is due and the loop has `idle_time` seconds to spare.
+    # Returns True when it collected.
+    def collect_if_due(self, idle_time):
+        if idle_time < self.gc_min_idle_time:
+            return False
+        now = time.monotonic()
+        elapsed = now - self.last_gc_time
+        is_due = self.gc_interval > 0 and elapsed >= self.gc_interval
+        if not is_due and (elapsed < self.gc_min_spacing or gc.mem_free() >= self.gc_min_free):
+            return False
+
+        started = time.monotonic_ns()
+        gc.collect()
+        self.gc_time_ns += time.monotonic_ns() - started
+        self.gc_count += 1
+        self.last_gc_time = now
+        return True
+
+    # The stages that allocated the most in a single run, biggest first
+    def get_top_stages(self, count = 3):
+        stages = sorted(self.stages.items(), key=lambda item: item[1][2], reverse=True)
+        return stages[:count]
+
+    # free=118KB low=96KB gc=12/40ms | mqtt +2.1KB/98KB ...
+    def get_summary(self):
+        summary = "free={}KB low={}KB gc={}/{}ms".format(gc.mem_free() // 1024, self.low_water // 1024,
+                                                        self.gc_count, self.gc_time_ns // 1000000)
+        for name, (_, min_free, max_allocated) in self.get_top_stages():
+            summary += " | {} +{:.1f}KB/{}KB".format(name, max_allocated / 1024, min_free // 1024)
+        return summary
+
+    # The low water mark and stage stats start over, the gc counters don't
+    def reset(self):
+        self.low_water = gc.mem_free()
+        self.stages = {}
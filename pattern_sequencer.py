@@ -0,0 +1,105 @@
+# ATMegaZero Pattern Sequencer
+#
+# Plays blink and beep patterns on the outputs (LEDs, buzzer, NeoPixel) without
+# blocking. A pattern is a declarative description: how long the output is on,
+# how long it is off, how many times it repeats and its priority. Several
+# patterns can be active on the same output, the one with the highest priority
+# drives it and the others carry on underneath, so when a warning beep is over
+# the status light goes back to whatever it was showing.
+#
+# update() has to be called regularly (from a scheduler task), it only writes to
+# an output when its value changes.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+
+class Pattern:
+    def __init__(self, on_time, off_time = 0, repeats = 1, priority = 0, value = True, off_value = None):
+        self.on_time = on_time # seconds
+        self.off_time = off_time # seconds, 0 keeps the output on for the whole pattern
+        self.repeats = repeats # 0 repeats forever, until stop() is called
+        self.priority = priority
+        self.value = value # value written while on, e.g. a color for the NeoPixel
+        self.off_value = off_value # None uses the channel's idle value
+
+    def get_duration(self):
+        if self.repeats == 0:
+            return None
+        return (self.on_time + self.off_time) * self.repeats
+
+    def value_at(self, elapsed, idle_value):
+        if self.off_time == 0:
+            return self.value
+        if (elapsed % (self.on_time + self.off_time)) < self.on_time:
+            return self.value
+        return idle_value if self.off_value is None else self.off_value
+
+# An output stays on until it is stopped
+STEADY = Pattern(on_time=1, repeats=0)
+
+class PatternSequencer:
+    def __init__(self):
+        # channel -> [write function, idle value, current value, active patterns]
+        # where each active pattern is [name, pattern, start time]
+        self.channels = {}
+
+    def add_channel(self, channel, write, idle_value = False):
+        self.channels[channel] = [write, idle_value, idle_value, []]
+        write(idle_value)
+
+    # Starts (or restarts) the pattern `name` on the channel. The output is
+    # updated right away, update() takes care of the rest.
+    def play(self, channel, name, pattern, now = None):
+        if now is None:
+            now = time.monotonic()
+        active = self.channels[channel][3]
+        for entry in active:
+            if entry[0] == name:
+                active.remove(entry)
+                break
+        active.append([name, pattern, now])
+        self._update_channel(self.channels[channel], now)
+
+    def stop(self, channel, name, now = None):
+        state = self.channels[channel]
+        for entry in state[3]:
+            if entry[0] == name:
+                state[3].remove(entry)
+                self._update_channel(state, time.monotonic() if now is None else now)
+                return
+
+    def is_playing(self, channel, name):
+        for entry in self.channels[channel][3]:
+            if entry[0] == name:
+                return True
+        return False
+
+    def update(self, now = None):
+        if now is None:
+            now = time.monotonic()
+        for state in self.channels.values():
+            if state[3]:
+                self._update_channel(state, now)
+
+    def _update_channel(self, state, now):
+        write, idle_value, current_value, active = state
+        winner = None
+        index = 0
+        while index < len(active):
+            entry = active[index]
+            duration = entry[1].get_duration()
+            if duration is not None and now - entry[2] >= duration:
+                active.pop(index)
+                continue
+            # on equal priority the pattern started last wins
+            if winner is None or entry[1].priority >= winner[1].priority:
+                winner = entry
+            index += 1
+
+        value = idle_value
+        if winner is not None:
+            value = winner[1].value_at(now - winner[2], idle_value)
+        if value != current_value:
+            state[2] = value
+            write(value)
@@ -8,6 +8,15 @@
 import time
 import board
 from digitalio import DigitalInOut, Pull
+from log import get_logger
+
+# How long a relay stays energized for a pulse, and how long after a pulse starts
+# before the same relay can be pulsed again (in seconds). Both can be changed per
+# relay with configure_relay().
+DEFAULT_PULSE_WIDTH = 0.5
+DEFAULT_MIN_RETRIGGER_INTERVAL = 1.0
+
+log = get_logger("relays")
 
 class Relay:
     one = 0
@@ -20,7 +29,7 @@ class Relay:
 
 class ATMegaZero_Relay_Shield:
     def __init__(self, *args):
-        print("Relay Shield Initialized")
+        log.info("Relay Shield Initialized")
         # Set up a pin for controlling the relays
         self.relay1 = DigitalInOut(board.IO5)
         self.relay1.switch_to_output()
@@ -30,23 +39,74 @@ class ATMegaZero_Relay_Shield:
         self.relay3.switch_to_output()
         self.relay4 = DigitalInOut(board.D13)
         self.relay4.switch_to_output()
+        self.relays = (self.relay1, self.relay2, self.relay3, self.relay4)
+
+        # Optional callback, called with the relay as soon as it is energized
+        self.on_relay_energized = None
+
+        # Every relay has its own pulse: the time it has to be released at (None
+        # when it isn't pulsing), its width and its minimum re-trigger interval.
+        self.pulse_deadlines = [None, None, None, None]
+        self.pulse_widths = [DEFAULT_PULSE_WIDTH] * 4
+        self.min_retrigger_intervals = [DEFAULT_MIN_RETRIGGER_INTERVAL] * 4
+        self.last_pulse_times = [None, None, None, None]
 
         self.reset()
-        
-    def toggle_relay(self, relay):
-        if relay == Relay.one:
-            self.relay1.value = False
-        elif relay == Relay.two:
-            self.relay2.value = False
-        elif relay == Relay.three:
-            self.relay3.value = False
-        elif relay == Relay.four:
-            self.relay4.value = False
-        time.sleep(0.5)
-        self.reset()
+
+    def configure_relay(self, relay, pulse_width = None, min_retrigger_interval = None):
+        if pulse_width is not None:
+            self.pulse_widths[relay] = pulse_width
+        if min_retrigger_interval is not None:
+            self.min_retrigger_intervals[relay] = min_retrigger_interval
+
+    # Energizes the relay and returns right away, update() releases it once the
+    # pulse is over. Pulses on different relays are independent and can overlap.
+    # Returns False when the relay is already pulsing or was pulsed less than its
+    # minimum re-trigger interval ago.
+    def pulse_relay(self, relay, pulse_width = None, now = None):
+        if now is None:
+            now = time.monotonic()
+        if self.pulse_deadlines[relay] is not None:
+            return False
+        last_pulse_time = self.last_pulse_times[relay]
+        if last_pulse_time is not None and now - last_pulse_time < self.min_retrigger_intervals[relay]:
+            return False
+
+        if pulse_width is None:
+            pulse_width = self.pulse_widths[relay]
+        self.relays[relay].value = False
+        self.last_pulse_times[relay] = now
+        self.pulse_deadlines[relay] = now + pulse_width
+        if self.on_relay_energized is not None:
+            self.on_relay_energized(relay)
+        return True
+
+    def is_pulsing(self, relay):
+        return self.pulse_deadlines[relay] is not None
+
+    # Call this from the main loop, it releases the relays whose pulse is over
+    def update(self, now = None):
+        if now is None:
+            now = time.monotonic()
+        for relay in range(4):
+            deadline = self.pulse_deadlines[relay]
+            if deadline is not None and now >= deadline:
+                self.release_relay(relay)
+
+    # Keeps the relay energized until release_relay(), for loads like a fan
+    def energize_relay(self, relay):
+        self.relays[relay].value = False
+        self.pulse_deadlines[relay] = None
+        if self.on_relay_energized is not None:
+            self.on_relay_energized(relay)
+
+    def is_energized(self, relay):
+        return not self.relays[relay].value
+
+    def release_relay(self, relay):
+        self.relays[relay].value = True
+        self.pulse_deadlines[relay] = None
 
     def reset(self):
-        self.relay1.value = True
-        self.relay2.value = True
-        self.relay3.value = True
-        self.relay4.value = True
\ No newline at end of file
+        for relay in range(4):
+            self.release_relay(relay)
@@ -0,0 +1,48 @@
+# ATMegaZero Report Policy
+#
+# Report-by-exception for the telemetry feeds. A value is only published when it
+# moved more than the feed's deadband since the last value we sent, never more
+# often than `min_interval` and always at least every `max_interval` (heartbeat)
+# so the dashboard knows the board is alive.
+#
+# For full documentation please visit https://atmegazero.com
+
+class ReportPolicy:
+    def __init__(self, deadband = 0, deadband_percent = 0, min_interval = 0, max_interval = 15 * 60):
+        self.deadband = deadband # absolute change, in the feed's units
+        self.deadband_percent = deadband_percent # change relative to the last sent value
+        self.min_interval = min_interval # seconds
+        self.max_interval = max_interval # seconds
+
+    def has_changed(self, last_value, value):
+        change = abs(value - last_value)
+        if change > self.deadband and self.deadband > 0:
+            return True
+        if self.deadband_percent > 0 and change * 100 > abs(last_value) * self.deadband_percent:
+            return True
+        # no deadband at all means any change counts
+        return self.deadband == 0 and self.deadband_percent == 0 and change != 0
+
+class FeedReporter:
+    def __init__(self, policies, default_policy = None):
+        self.policies = policies
+        self.default_policy = default_policy or ReportPolicy()
+        self.last_values = {}
+        self.last_report_times = {}
+
+    def should_report(self, feed, value, now):
+        last_value = self.last_values.get(feed)
+        if last_value is None:
+            return True
+
+        policy = self.policies.get(feed, self.default_policy)
+        elapsed = now - self.last_report_times[feed]
+        if elapsed < policy.min_interval:
+            return False
+        if elapsed >= policy.max_interval:
+            return True
+        return policy.has_changed(last_value, value)
+
+    def mark_reported(self, feed, value, now):
+        self.last_values[feed] = value
+        self.last_report_times[feed] = now
@@ -0,0 +1,139 @@
+# ATMegaZero Cooperative Scheduler
+#
+# A tiny asyncio-style task scheduler for CircuitPython. Nothing in here blocks:
+# periodic tasks are plain callables that run every `interval` seconds, and
+# coroutine tasks are generators that `yield` the number of seconds they want
+# to sleep before being resumed. This lets long sequences (like the auto-close
+# countdown) be written top to bottom without stalling the MQTT loop.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+from log import get_logger
+
+log = get_logger("scheduler")
+
+# Never sleep longer than this between scheduler passes, so a task added from a
+# callback is picked up quickly even if every other task is far in the future.
+MAX_IDLE_SLEEP = 0.05
+
+class Task:
+    def __init__(self, name, callback = None, interval = 0, coroutine = None, on_error = None):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.coroutine = coroutine
+        self.on_error = on_error
+        self.next_run = 0
+        self.done = False
+
+    def cancel(self):
+        if self.coroutine is not None:
+            try:
+                self.coroutine.close()
+            except Exception:
+                pass
+        self.done = True
+
+class Scheduler:
+    def __init__(self, max_idle_sleep = MAX_IDLE_SLEEP):
+        self.tasks = []
+        self.max_idle_sleep = max_idle_sleep
+        # Optional MemoryMonitor, gets the heap usage of every task run
+        self.memory_monitor = None
+        # Optional callback, called with the idle time before the scheduler sleeps
+        self.on_idle = None
+
+    # Run `callback` every `interval` seconds. An interval of 0 runs it on every pass.
+    def every(self, interval, callback, name = None, start_delay = 0, on_error = None):
+        task = Task(name or callback.__name__, callback = callback, interval = interval, on_error = on_error)
+        task.next_run = time.monotonic() + start_delay
+        self.tasks.append(task)
+        return task
+
+    # Run a generator based coroutine. The generator yields how long (in seconds)
+    # it wants to sleep; yielding None or 0 resumes it on the next pass.
+    def spawn(self, coroutine, name = None, on_error = None):
+        task = Task(name or "coroutine", coroutine = coroutine, on_error = on_error)
+        task.next_run = time.monotonic()
+        self.tasks.append(task)
+        return task
+
+    # Runs the task on the next pass instead of waiting for its next_run, e.g. to
+    # wake up a coroutine that is sleeping until a deadline that just changed
+    def wake(self, task):
+        if task is not None and not task.done:
+            task.next_run = time.monotonic()
+
+    def is_running(self, task):
+        return task is not None and not task.done
+
+    # Runs every task that is due and returns the number of seconds until the
+    # next one is due.
+    def run_once(self):
+        now = time.monotonic()
+        next_deadline = now + self.max_idle_sleep
+
+        index = 0
+        while index < len(self.tasks):
+            task = self.tasks[index]
+            if not task.done and now >= task.next_run:
+                self._step(task, now)
+                now = time.monotonic()
+
+            if task.done:
+                self.tasks.pop(index)
+                continue
+
+            if task.next_run < next_deadline:
+                next_deadline = task.next_run
+            index += 1
+
+        return max(0, next_deadline - time.monotonic())
+
+    # Runs a single scheduler pass and sleeps until the next task is due.
+    def tick(self):
+        idle_time = self.run_once()
+        if idle_time > 0 and self.on_idle is not None:
+            deadline = time.monotonic() + idle_time
+            self.on_idle(idle_time)
+            idle_time = deadline - time.monotonic()
+        if idle_time > 0:
+            time.sleep(idle_time)
+
+    def run_forever(self):
+        while True:
+            self.tick()
+
+    def _step(self, task, now):
+        if self.memory_monitor is not None:
+            started_alloc = self.memory_monitor.begin()
+            self._run(task, now)
+            self.memory_monitor.end(task.name, started_alloc)
+        else:
+            self._run(task, now)
+
+    def _run(self, task, now):
+        try:
+            if task.coroutine is not None:
+                try:
+                    delay = next(task.coroutine)
+                except StopIteration:
+                    task.done = True
+                    return
+                task.next_run = time.monotonic() + (delay or 0)
+            else:
+                try:
+                    task.callback()
+                finally:
+                    # Keep a steady cadence, but don't try to catch up on missed
+                    # runs. A failed run waits for its next turn like any other.
+                    task.next_run += task.interval
+                    if task.next_run < now:
+                        task.next_run = now + task.interval
+        except Exception as e:
+            log.error("Task %s failed: %s", task.name, e)
+            if task.coroutine is not None:
+                task.done = True
+            if task.on_error is not None:
+                task.on_error(task, e)
@@ -0,0 +1,134 @@
+# ATMegaZero SD Card Logger
+#
+# Buffered logger for the SD card. Messages are copied into a fixed size
+# preallocated buffer and written to the card in batches, either when the buffer
+# fills past `flush_threshold` bytes or every `flush_interval` seconds. The file
+# stays open between flushes and is rotated once it grows past `max_file_size`,
+# keeping `max_files` old copies around (atmegazero_logs.txt.1, .2, ...).
+#
+# For full documentation please visit https://atmegazero.com
+
+import os
+import time
+
+class SDLogger:
+    def __init__(self, path, time_source = None, buffer_size = 2048, flush_threshold = 1536,
+                 flush_interval = 30, max_file_size = 256 * 1024, max_files = 3):
+        self.path = path
+        self.time_source = time_source
+        self.flush_threshold = min(flush_threshold, buffer_size)
+        self.flush_interval = flush_interval
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+
+        self.buffer = bytearray(buffer_size)
+        self.length = 0
+        self.dropped_bytes = 0
+        self.last_flush_time = time.monotonic()
+
+        self.file = None
+        self.file_size = 0
+
+    # Never raises, it is called from error handlers (the scheduler's included)
+    def log(self, message):
+        timestamp = None
+        if self.time_source is not None:
+            try:
+                timestamp = self.time_source()
+            except Exception as e:
+                # the RTC is on the I2C bus too, keep the message without its time
+                print("Error reading the log timestamp\n", e)
+        if timestamp is not None:
+            line = "{} - {}\n".format(timestamp, message)
+        else:
+            line = "{}\n".format(message)
+        try:
+            self.write(line.encode())
+        except Exception as e:
+            print("Error buffering the log message\n", e)
+
+    def write(self, data):
+        size = len(data)
+        if self.length + size > len(self.buffer):
+            self.flush()
+
+        if size > len(self.buffer):
+            # Never grow the buffer, keep the beginning of oversized messages
+            self.dropped_bytes += size - len(self.buffer)
+            size = len(self.buffer)
+
+        self.buffer[self.length:self.length + size] = data[:size]
+        self.length += size
+
+        if self.length >= self.flush_threshold:
+            self.flush()
+
+    # Meant to be called periodically, flushes the buffer once flush_interval has passed.
+    def update(self):
+        if self.length > 0 and (time.monotonic() - self.last_flush_time) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.monotonic()
+        if self.length == 0:
+            return
+
+        try:
+            if self.file is None:
+                self._open()
+            self.file.write(memoryview(self.buffer)[:self.length])
+            self.file.flush()
+            self.file_size += self.length
+        except Exception as e:
+            print("Error logging to SD Card\n", e)
+            self._close_file()
+            self.dropped_bytes += self.length
+
+        self.length = 0
+
+        if self.file_size >= self.max_file_size:
+            self.rotate()
+
+    def rotate(self):
+        self._close_file()
+        try:
+            # atmegazero_logs.txt.2 -> .3, .1 -> .2, atmegazero_logs.txt -> .1
+            for index in range(self.max_files - 1, 0, -1):
+                self._rename("{}.{}".format(self.path, index), "{}.{}".format(self.path, index + 1))
+            self._rename(self.path, self.path + ".1")
+        except Exception as e:
+            print("Error rotating the log file\n", e)
+        self.file_size = 0
+
+    # Flushes whatever is left in the buffer and closes the file. Call this before
+    # supervisor.reload() so the last messages make it to the card.
+    def close(self):
+        self.flush()
+        self._close_file()
+
+    def _open(self):
+        self.file = open(self.path, "ab")
+        try:
+            self.file_size = os.stat(self.path)[6]
+        except OSError:
+            self.file_size = 0
+
+    def _close_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except Exception:
+                pass
+            self.file = None
+
+    def _rename(self, source, destination):
+        try:
+            os.stat(source)
+        except OSError:
+            return
+
+        try:
+            os.remove(destination)
+        except OSError:
+            pass
+        os.rename(source, destination)
@@ -6,36 +6,74 @@
 # For full documentation please visit https://atmegazero.com
 
 import time
+from array import array
 import board
 import busio
-import digitalio
-import adafruit_bme280
-import adafruit_ds1307
-import adafruit_mpu6050
-import adafruit_sgp40
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+from log import get_logger
 
-i2c = busio.I2C(board.SCL, board.SDA)
+log = get_logger("sensors")
 
-# BME280 Sensor
-bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c)
-# change this to match the location's pressure (hPa) at sea level
-bme280.sea_level_pressure = 1013.25
+# Sensors to use. Each driver is only imported and initialized the first time
+# its sensor is used, so a sensor that isn't listed here costs nothing at boot.
+# Add "mpu6050" to use the accelerometer, the garage uses it to feel the door motors.
+ENABLED_SENSORS = ("bme280", "rtc", "sgp40", "ads1115")
+
+# Used for the SGP40 humidity compensation until the BME280 has samples
+DEFAULT_COMPENSATION = (25, 50) # celsius, %RH
+
+# The SGP40 needs up to 30ms to measure after the command, plus some margin
+# for the coarse time.monotonic() of a board that has been up for days
+SGP40_MEASURE_TIME = 0.04
+SGP40_MEASURE_COMMAND = (0x26, 0x0F)
+
+# How often the in-memory clock is re-anchored to the DS1307
+RTC_RESYNC_INTERVAL = 60 * 60 # every hour
+RTC_RETRY_INTERVAL = 60 # after a failed resync
+
+# The driver imports live inside these functions on purpose (import trimming).
+def create_bme280(i2c):
+    import adafruit_bme280
+    bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c)
+    # change this to match the location's pressure (hPa) at sea level
+    bme280.sea_level_pressure = 1013.25
+    return bme280
 
 # RealTimeClock(RTC)
-rtc = adafruit_ds1307.DS1307(i2c)
+def create_rtc(i2c):
+    import adafruit_ds1307
+    return adafruit_ds1307.DS1307(i2c)
 
 # Accelerometer
-mpu = adafruit_mpu6050.MPU6050(i2c, address=0x69)
+def create_mpu6050(i2c):
+    import adafruit_mpu6050
+    return adafruit_mpu6050.MPU6050(i2c, address=0x69)
 
 # Gass Sensor
-sgp = adafruit_sgp40.SGP40(i2c)
+def create_sgp40(i2c):
+    import adafruit_sgp40
+    return adafruit_sgp40.SGP40(i2c)
 
 # Create analog-to-digital converter
-ads = ADS.ADS1115(i2c)
-# Create single-ended input on channel 0
-chan = AnalogIn(ads, ADS.P0)
+def create_ads1115(i2c):
+    import adafruit_ads1x15.ads1115 as ADS
+    return ADS.ADS1115(i2c)
+
+DEVICE_FACTORIES = {
+    "bme280": create_bme280,
+    "rtc": create_rtc,
+    "mpu6050": create_mpu6050,
+    "sgp40": create_sgp40,
+    "ads1115": create_ads1115,
+}
+
+# Which device each sampled value comes from
+SAMPLE_SOURCES = {
+    "brightness": "ads1115",
+    "temperature": "bme280",
+    "humidity": "bme280",
+    "pressure": "bme280",
+    "voc": "sgp40",
+}
 
 class Temperature_Type:
     fahrenheit = 0
@@ -44,74 +82,409 @@ class Temperature_Type:
         assert type in ( self.fahrenheit, self.celsius)
         self.selection = type
 
+# Serves the wall-clock time from memory. The DS1307 is read once and anchored to
+# time.monotonic(), then re-read every `resync_interval` seconds. Each resync
+# measures how far the monotonic clock drifted from the RTC (whole seconds, that
+# is the DS1307 resolution). A failed resync keeps the old anchor and is retried
+# after `retry_interval` seconds, only the very first read raises.
+class RTC_Clock:
+    def __init__(self, read_datetime, resync_interval = RTC_RESYNC_INTERVAL, retry_interval = RTC_RETRY_INTERVAL):
+        self.read_datetime = read_datetime
+        self.resync_interval = resync_interval
+        self.retry_interval = retry_interval
+        self.anchor_seconds = 0
+        self.anchor_monotonic = 0
+        self.next_sync_time = 0 # time.monotonic() of the next resync
+        self.is_synced = False
+        self.last_drift = 0 # seconds, RTC time minus our estimate at the last resync
+        self.sync_count = 0
+        self.error_count = 0
+
+    # Returns the time.monotonic() the clock is anchored at afterwards
+    def sync(self):
+        try:
+            rtc_seconds = int(time.mktime(self.read_datetime()))
+        except Exception as e:
+            if not self.is_synced:
+                raise
+            self.error_count += 1
+            self.next_sync_time = time.monotonic() + self.retry_interval
+            log.warning("Error reading the RTC, keeping the current time: %s", e)
+            return time.monotonic()
+
+        now = time.monotonic()
+        if self.is_synced:
+            self.last_drift = rtc_seconds - self._estimate(now)
+
+        self.anchor_seconds = rtc_seconds
+        self.anchor_monotonic = now
+        self.next_sync_time = now + self.resync_interval
+        self.is_synced = True
+        self.sync_count += 1
+        return now
+
+    # Seconds since the epoch, as an int
+    def now_seconds(self):
+        now = time.monotonic()
+        if not self.is_synced or now >= self.next_sync_time:
+            now = self.sync()
+        return self._estimate(now)
+
+    def now(self):
+        return time.localtime(self.now_seconds())
+
+    def _estimate(self, now):
+        # keep the large epoch value as an int, floats on the board don't have the precision for it
+        return self.anchor_seconds + int(now - self.anchor_monotonic)
+
+# CRC-8 of the SGP40 words (polynomial 0x31, init 0xFF)
+def sgp40_crc(data):
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x31) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+# One SGP40 measurement in two steps, so nothing waits on the sensor: start()
+# sends the measure command, read() fetches the result SGP40_MEASURE_TIME later.
+# (SGP40.raw in the driver sleeps 500ms in between.)
+class SGP40_Reader:
+    def __init__(self, i2c_device):
+        self.i2c_device = i2c_device
+        self.command = bytearray(8)
+        self.command[0], self.command[1] = SGP40_MEASURE_COMMAND
+        self.result = bytearray(3)
+
+    # humidity and temperature compensation, celsius and %RH
+    def start(self, temperature, humidity):
+        humidity_ticks = int(max(0, min(100, humidity)) * 65535 / 100)
+        temperature_ticks = int((max(-45, min(130, temperature)) + 45) * 65535 / 175)
+        command = self.command
+        command[2], command[3] = humidity_ticks >> 8, humidity_ticks & 0xFF
+        command[4] = sgp40_crc(command[2:4])
+        command[5], command[6] = temperature_ticks >> 8, temperature_ticks & 0xFF
+        command[7] = sgp40_crc(command[5:7])
+        with self.i2c_device as i2c:
+            i2c.write(command)
+
+    # The raw ticks of the measurement started by start()
+    def read(self):
+        result = self.result
+        with self.i2c_device as i2c:
+            i2c.readinto(result)
+        if sgp40_crc(result[0:2]) != result[2]:
+            raise ValueError("SGP40 CRC mismatch")
+        return (result[0] << 8) | result[1]
+
+# How often each sensor is sampled and how many samples are averaged.
+# name: (interval in seconds, window size)
+SAMPLE_RATES = {
+    "brightness": (1, 60), # 1 minute window
+    "temperature": (5, 12), # 1 minute window
+    "humidity": (5, 12), # 1 minute window
+    "pressure": (10, 6), # 1 minute window
+    "voc": (1, 60), # the SGP40 VOC algorithm expects one sample every second, see run_voc_sampling()
+}
+
+# Fixed size ring buffer of float samples backed by an array, so adding a sample
+# never allocates. Stats are computed in a single pass over the array.
+class Sample_Buffer:
+    def __init__(self, size):
+        self.values = array("f", bytes(4 * size))
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    # Returns (mean, min, max) of the samples in the window, or None when empty
+    def stats(self):
+        if self.count == 0:
+            return None
+
+        values = self.values
+        total = minimum = maximum = values[0]
+        for i in range(1, self.count):
+            value = values[i]
+            total += value
+            if value < minimum:
+                minimum = value
+            elif value > maximum:
+                maximum = value
+
+        return (total / self.count, minimum, maximum)
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.values[(self.index - 1) % self.size]
+
+class Sensor_Sampler:
+    def __init__(self, name, read, interval, window_size):
+        self.name = name
+        self.read = read
+        self.interval = interval
+        self.buffer = Sample_Buffer(window_size)
+        self.next_sample_time = 0
+        self.error_count = 0
+
+# Samples every registered sensor at its own rate. update() is meant to be called
+# often from a scheduler task, it only reads the sensors that are due.
+class Sampling_Engine:
+    def __init__(self):
+        self.samplers = {}
+
+    def add(self, name, read, interval, window_size):
+        self.samplers[name] = Sensor_Sampler(name, read, interval, window_size)
+
+    def update(self, now = None):
+        if now is None:
+            now = time.monotonic()
+
+        for sampler in self.samplers.values():
+            # samplers without a read function are fed by their own task
+            if sampler.read is None or now < sampler.next_sample_time:
+                continue
+
+            # keep the cadence instead of drifting by up to one update interval per sample
+            sampler.next_sample_time += sampler.interval
+            if sampler.next_sample_time <= now:
+                sampler.next_sample_time = now + sampler.interval
+            try:
+                sampler.buffer.add(sampler.read())
+            except Exception as e:
+                # skip this sample, the window still has the previous ones
+                sampler.error_count += 1
+                log.warning("Error sampling %s: %s", sampler.name, e)
+
+    def stats(self, name):
+        sampler = self.samplers.get(name)
+        if sampler is None:
+            return None
+        return sampler.buffer.stats()
+
+    def latest(self, name):
+        sampler = self.samplers.get(name)
+        if sampler is None:
+            return None
+        return sampler.buffer.latest()
+
 class ATMegaZero_Sensors_Shield:
-    def __init__(self, *args):
-        print("Sensors Shield Initialized")
-        
+    def __init__(self, enabled_sensors = ENABLED_SENSORS, *args):
+        log.info("Sensors Shield Initialized")
+        self.enabled_sensors = enabled_sensors
+        self.i2c = None
+        self.devices = {}
+        self.light_channel = None
+        self.clock = RTC_Clock(self.read_rtc_datetime)
+        self.sampling_engine = None
+        self.temperature_type = Temperature_Type.fahrenheit
+
+    def is_enabled(self, name):
+        return name in self.enabled_sensors
+
+    # Returns the driver for the given sensor, creating it on first use
+    def device(self, name):
+        device = self.devices.get(name)
+        if device is None:
+            if not self.is_enabled(name):
+                raise RuntimeError("The {} sensor is not enabled".format(name))
+            if self.i2c is None:
+                self.i2c = busio.I2C(board.SCL, board.SDA)
+            device = DEVICE_FACTORIES[name](self.i2c)
+            self.devices[name] = device
+        return device
+
+    # Single-ended input on channel 0 of the ADC
+    def get_light_channel(self):
+        if self.light_channel is None:
+            import adafruit_ads1x15.ads1115 as ADS
+            from adafruit_ads1x15.analog_in import AnalogIn
+            self.light_channel = AnalogIn(self.device("ads1115"), ADS.P0)
+        return self.light_channel
+
+    def read_rtc_datetime(self):
+        return self.device("rtc").datetime
+
+    def start_sampling(self, sample_rates = SAMPLE_RATES, temperature_type = Temperature_Type.fahrenheit):
+        if self.is_enabled("ads1115"):
+            # The ADC converts continuously, so reading the light sensor just returns
+            # the latest conversion instead of waiting for a new one.
+            from adafruit_ads1x15.ads1x15 import Mode
+            self.device("ads1115").mode = Mode.CONTINUOUS
+
+        if temperature_type == Temperature_Type.fahrenheit:
+            read_temperature = lambda: self.device("bme280").temperature * 9 / 5 + 32
+        else:
+            read_temperature = lambda: self.device("bme280").temperature
+
+        readers = {
+            "brightness": lambda: self.get_light_channel().value / 1000,
+            "temperature": read_temperature,
+            "humidity": lambda: self.device("bme280").relative_humidity,
+            "pressure": lambda: self.device("bme280").pressure,
+            "voc": None,
+        }
+
+        self.temperature_type = temperature_type
+        self.sampling_engine = Sampling_Engine()
+        for name, (interval, window_size) in sample_rates.items():
+            if self.is_enabled(SAMPLE_SOURCES[name]):
+                self.sampling_engine.add(name, readers[name], interval, window_size)
+
+    def update_sampling(self):
+        if self.sampling_engine is not None:
+            self.sampling_engine.update()
+
+    # Returns (mean, min, max) for the sampled sensor, or None if there are no samples yet
+    def get_sensor_stats(self, name):
+        if self.sampling_engine is None:
+            return None
+        return self.sampling_engine.stats(name)
+
+    # Returns the latest sample of a sampled sensor, or None
+    def get_latest_sample(self, name):
+        if self.sampling_engine is None:
+            return None
+        return self.sampling_engine.latest(name)
+
+    # (celsius, %RH) from the latest BME280 samples, for the SGP40 compensation
+    def get_compensation(self):
+        temperature = self.get_latest_sample("temperature")
+        humidity = self.get_latest_sample("humidity")
+        if temperature is None or humidity is None:
+            return DEFAULT_COMPENSATION
+        if self.temperature_type == Temperature_Type.fahrenheit:
+            temperature = (temperature - 32) * 5 / 9
+        return (temperature, humidity)
+
+    # Scheduler coroutine for the "voc" sample. Every second the SGP40 measures
+    # (compensated with the latest BME280 samples) and the raw ticks go through
+    # Sensirion's VOC algorithm from the driver package, which keeps a fixed size
+    # state. The index is 100 for the average of the last 24 hours, up to 500 is
+    # worse, and 0 while the algorithm warms up (those are skipped).
+    def run_voc_sampling(self):
+        from adafruit_sgp40.voc_algorithm import VOCAlgorithm
+        sampler = self.sampling_engine.samplers["voc"]
+        reader = SGP40_Reader(self.device("sgp40").i2c_device)
+        algorithm = VOCAlgorithm()
+        algorithm.vocalgorithm_init()
+
+        next_sample_time = time.monotonic()
+        while True:
+            try:
+                temperature, humidity = self.get_compensation()
+                reader.start(temperature, humidity)
+                yield SGP40_MEASURE_TIME
+                index = algorithm.vocalgorithm_process(reader.read())
+                if index > 0:
+                    sampler.buffer.add(index)
+            except Exception as e:
+                sampler.error_count += 1
+                log.warning("Error sampling voc: %s", e)
+
+            # the algorithm expects a steady cadence
+            next_sample_time += sampler.interval
+            now = time.monotonic()
+            if next_sample_time <= now:
+                next_sample_time = now + sampler.interval
+            yield next_sample_time - now
+
     def get_date_time(self):
-        t = rtc.datetime
+        t = self.clock.now()
         hour = t.tm_hour % 12
-        date_string = "{}/{}/{} - {}:{:02}:{:02}".format(t.tm_mon, t.tm_mday, t.tm_year, hour, t.tm_min, t.tm_sec)
-        print("Date/Time: ", date_string)
-        return date_string
+        return "{}/{}/{} - {}:{:02}:{:02}".format(t.tm_mon, t.tm_mday, t.tm_year, hour, t.tm_min, t.tm_sec)
 
     def get_current_time_as_tuple(self):
-        t = rtc.datetime
+        t = self.clock.now()
         return (t.tm_hour, t.tm_min)
 
     def get_date_tuple(self):
-        t = rtc.datetime
+        t = self.clock.now()
         return (t.tm_mon, t.tm_mday, t.tm_year)
 
+    # How many seconds the cached clock was off from the RTC at the last resync
+    def get_clock_drift(self):
+        return self.clock.last_drift
+
+    # The getters return numbers, format them where they are displayed or published
+
     def get_temperature(self, type = Temperature_Type.fahrenheit):
         if type == Temperature_Type.fahrenheit:
-            temperature = bme280.temperature * 9 / 5 + 32
+            temperature = self.device("bme280").temperature * 9 / 5 + 32
         else:
-            temperature = bme280.temperature
+            temperature = self.device("bme280").temperature
 
-        print("Temperature: ", str(temperature))
+        log.debug("Temperature: %s", temperature)
         return temperature
 
+    # hPa
     def get_barometric_pressure(self):
-        barometric_pressure = "%0.1f hPa" % bme280.pressure
-        print("Barometric Pressure: ", barometric_pressure)
+        barometric_pressure = self.device("bme280").pressure
+        log.debug("Barometric Pressure: %s hPa", barometric_pressure)
         return barometric_pressure
 
+    # meters
     def get_altitude(self):
-        altitude = "%0.2f meters" % bme280.altitude
-        print("Altitude: ", altitude)
+        altitude = self.device("bme280").altitude
+        log.debug("Altitude: %s meters", altitude)
         return altitude
-    
+
     def get_humidity(self):
-        humidity = bme280.relative_humidity
-        print("Humidity: ", str(humidity))
+        humidity = self.device("bme280").relative_humidity
+        log.debug("Humidity: %s", humidity)
         return humidity
 
+    # (x, y, z) in m/s^2
     def get_accelerometer(self):
-        acceleration = "X:%.2f, Y: %.2f, Z: %.2f m/s^2" % (mpu.acceleration)
-        print("Acceleration: ", acceleration)
+        acceleration = self.device("mpu6050").acceleration
+        log.debug("Acceleration: %s m/s^2", acceleration)
         return acceleration
-    
+
+    # Reads the MPU6050 FIFO in bursts to tell when a door motor is running, see
+    # vibration_monitor.py. Returns None when ulab isn't available.
+    def create_vibration_monitor(self, **kwargs):
+        import vibration_monitor
+        if not vibration_monitor.is_supported():
+            log.warning("ulab is not available, vibration monitoring is disabled")
+            return None
+        return vibration_monitor.VibrationMonitor(self.device("mpu6050").i2c_device, **kwargs)
+
+    # (x, y, z) in degrees/s
     def get_gyroscope(self):
-        gyro = "X:%.2f, Y: %.2f, Z: %.2f degrees/s" % (mpu.gyro)
-        print("Gyro: ", gyro)
+        gyro = self.device("mpu6050").gyro
+        log.debug("Gyro: %s degrees/s", gyro)
         return gyro
 
     def get_raw_gass_value(self):
-        raw_gass = sgp.raw
-        print("Raw Gas: ", raw_gass)
+        raw_gass = self.device("sgp40").raw
+        log.debug("Raw Gas: %s", raw_gass)
         return raw_gass
 
     def get_light_sensor_value(self):
-        print("{:>5}\t{:>5.3f}".format(chan.value, chan.voltage))
-        brightness = chan.value / 1000
-        print("brightness: ", brightness)
+        brightness = self.get_light_channel().value / 1000
+        log.debug("brightness: %s", brightness)
         return brightness
 
     def set_date_time(self):
             # year, mon, date, hour, min, sec, wday, yday, isdst
-        t = time.struct_time((2021, 04, 7, 19, 46, 0, 2, -1, -1))
+        t = time.struct_time((2021, 4, 7, 19, 46, 0, 2, -1, -1))
         # you must set year, mon, date, hour, min, sec and weekday
         # yearday is not supported, isdst can be set but we don't do anything with it at this time
-        print("Setting time to:", t)  # uncomment for debugging
-        rtc.datetime = t
\ No newline at end of file
+        log.debug("Setting time to: %s", t)
+        self.device("rtc").datetime = t
+        # re-anchor the cached clock to the new time
+        self.clock.sync()
+        self.clock.last_drift = 0
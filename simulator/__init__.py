@@ -0,0 +1,143 @@
+# ATMegaZero Simulator
+#
+# Runs the unchanged garage firmware on a regular computer (CPython on Linux).
+# install() puts fake versions of the CircuitPython modules (board, digitalio,
+# busio, wifi, socketpool, neopixel, storage, supervisor, ...) and the sensor
+# drivers in sys.modules, replaces time.monotonic()/time.sleep() with a virtual
+# clock, redirects /sd to a local directory and connects MiniMQTT to an
+# in-process broker.
+#
+#   from simulator import install
+#   simulation = install()
+#   from garage_manager import Garage_Manager
+#   manager = Garage_Manager()
+#   simulation.run(manager, seconds=60)
+
+import gc
+import os
+import sys
+import tempfile
+import time
+import types
+
+from simulator.clock import VirtualClock
+from simulator.hardware import Hardware, ReloadRequested
+from simulator.mqtt import FakeBroker, MQTT, MMQTTException
+from simulator.sdcard import SDCardRedirect
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Relay pin and magnetic switch pin of each door
+DOOR_PINS = (("IO5", "D10"), ("D8", "D9"))
+
+# Flips a door's magnetic switch some time after its relay is pulsed, like a real
+# door opener would. The motor runs (and shakes the accelerometer) while the door
+# travels, a jammed door's motor gives up after `jam_time` seconds.
+class GarageDoorModel:
+    def __init__(self, clock, hardware, relay_pin, sensor_pin, travel_time = 12.0, jam_time = 3.0):
+        self.clock = clock
+        self.hardware = hardware
+        self.relay_pin = relay_pin
+        self.sensor_pin = sensor_pin
+        self.travel_time = travel_time
+        self.jam_time = jam_time
+        self.is_moving = False
+        self.is_jammed = False
+        self.actuation_count = 0
+        relay_pin.listeners.append(self.relay_changed)
+
+    def relay_changed(self, pin, value):
+        # the relays are active low
+        if value or self.is_moving:
+            return
+        self.actuation_count += 1
+        self.is_moving = True
+        self.hardware.motors_running += 1
+        if self.is_jammed:
+            self.clock.call_later(self.jam_time, self.stop_motor)
+        else:
+            self.clock.call_later(self.travel_time, self.finish_travel)
+
+    def stop_motor(self):
+        self.is_moving = False
+        self.hardware.motors_running -= 1
+
+    def finish_travel(self):
+        self.stop_motor()
+        self.sensor_pin.set(not self.sensor_pin.value)
+
+class Simulation:
+    def __init__(self, clock, hardware, broker, sd_card):
+        self.clock = clock
+        self.hardware = hardware
+        self.broker = broker
+        self.sd_card = sd_card
+        self.doors = []
+        # virtual time of the soft reboot that ended the last run(), if any
+        self.reload_time = None
+        for relay_name, sensor_name in DOOR_PINS:
+            self.doors.append(GarageDoorModel(clock, hardware, hardware.pin(relay_name), hardware.pin(sensor_name)))
+
+    # Calls manager.loop() until `seconds` of virtual time went by. The optional
+    # callback runs after every iteration with the real duration of the pass.
+    # A soft reboot (supervisor.reload()) ends the run with ReloadRequested, the
+    # manager is gone at that point like on the board.
+    def run(self, manager, seconds, on_iteration = None):
+        end_time = self.clock.monotonic() + seconds
+        while self.clock.monotonic() < end_time:
+            started = time.perf_counter()
+            try:
+                manager.loop()
+            except ReloadRequested:
+                self.reload_time = self.clock.monotonic()
+                raise
+            if on_iteration is not None:
+                on_iteration(time.perf_counter() - started)
+
+    def set_door_opened(self, index, is_opened):
+        self.hardware.pin(DOOR_PINS[index][1]).set(is_opened)
+
+    def uninstall(self):
+        self.sd_card.uninstall()
+
+_original_time_functions = None
+
+def install(sd_root = None, seed = 1, start_epoch = None):
+    global _original_time_functions
+
+    clock = VirtualClock(start_epoch)
+    hardware = Hardware(clock, seed)
+    broker = FakeBroker(clock)
+
+    modules = hardware.build_modules()
+    MQTT.broker_instance = broker
+    minimqtt_package = types.ModuleType("adafruit_minimqtt")
+    minimqtt_package.__path__ = []
+    minimqtt = types.ModuleType("adafruit_minimqtt.adafruit_minimqtt")
+    minimqtt.MQTT = MQTT
+    minimqtt.MMQTTException = MMQTTException
+    minimqtt_package.adafruit_minimqtt = minimqtt
+    modules["adafruit_minimqtt"] = minimqtt_package
+    modules["adafruit_minimqtt.adafruit_minimqtt"] = minimqtt
+    sys.modules.update(modules)
+
+    # The firmware's secrets.py shadows the standard library module of the same name
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    if "secrets" in sys.modules and not hasattr(sys.modules["secrets"], "secrets"):
+        del sys.modules["secrets"]
+
+    if _original_time_functions is None:
+        _original_time_functions = (time.monotonic, time.monotonic_ns, time.sleep)
+    time.monotonic = clock.monotonic
+    time.monotonic_ns = clock.monotonic_ns
+    time.sleep = clock.sleep
+    gc.mem_free = lambda: hardware.mem_free
+    gc.mem_alloc = lambda: 256 * 1024 - hardware.mem_free
+
+    if sd_root is None:
+        sd_root = tempfile.mkdtemp(prefix="atmegazero_sd_")
+    sd_card = SDCardRedirect(sd_root)
+    sd_card.install()
+
+    return Simulation(clock, hardware, broker, sd_card)
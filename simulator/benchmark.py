@@ -0,0 +1,153 @@
+# ATMegaZero Simulator - Loop Benchmark
+#
+# Boots the garage firmware in the simulator and runs it for a few virtual
+# minutes while the "dashboard" sends door commands, then reports:
+#   - how long a Garage_Manager.loop() pass takes (real time, microseconds)
+#   - how long a pass was stuck in a blocking driver call (virtual time)
+#   - command-to-relay latency (virtual time, from the broker receiving the
+#     command to the relay pin going low)
+#   - publishes per minute
+#   - SD card log throughput
+#
+#   python -m simulator.benchmark --minutes 10
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import time
+
+from simulator import install
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(values, scale = 1000):
+    if not values:
+        return {"count": 0, "mean": 0, "p50": 0, "p95": 0, "max": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) * scale,
+        "p50": percentile(values, 0.50) * scale,
+        "p95": percentile(values, 0.95) * scale,
+        "max": max(values) * scale,
+    }
+
+def run_benchmark(minutes = 10, command_interval = 30, log_messages = 5000, seed = 1):
+    simulation = install(seed=seed)
+    clock = simulation.clock
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        import garage_manager
+        boot_started = time.perf_counter()
+        manager = garage_manager.Garage_Manager()
+        boot_time = time.perf_counter() - boot_started
+    virtual_boot_time = clock.monotonic()
+
+    # Door commands from the dashboard, alternating between the two doors
+    pending_commands = []
+    relay_latencies = []
+    door_feeds = [door.button_feed for door in manager.doors]
+
+    def relay_energized(door_index):
+        def listener(pin, value):
+            if value:
+                return
+            for command in pending_commands:
+                if command[0] == door_index:
+                    relay_latencies.append(clock.monotonic() - command[1])
+                    pending_commands.remove(command)
+                    break
+        return listener
+
+    for index, door in enumerate(simulation.doors):
+        door.relay_pin.listeners.append(relay_energized(index))
+
+    def send_command(number):
+        def send():
+            door_index = number % len(door_feeds)
+            pending_commands.append((door_index, clock.monotonic()))
+            simulation.broker.inject(door_feeds[door_index], "OPEN" if (number // 2) % 2 == 0 else "CLOSE")
+        return send
+
+    # a random phase within the second, so the commands don't always miss (or
+    # always hit) a task that runs once a second
+    phases = random.Random(seed)
+    start_time = clock.monotonic()
+    command_count = int(minutes * 60 // command_interval)
+    for number in range(command_count):
+        # offset the commands so they don't line up with the task intervals
+        clock.call_at(start_time + (number + 0.37) * command_interval + phases.random(), send_command(number))
+
+    iteration_times = []
+    blocked_times = []
+    last_blocked_time = [clock.blocked_time]
+
+    def on_iteration(duration):
+        iteration_times.append(duration)
+        blocked_times.append(clock.blocked_time - last_blocked_time[0])
+        last_blocked_time[0] = clock.blocked_time
+
+    publishes_before = simulation.broker.publish_count
+    sd_bytes_before = simulation.sd_card.bytes_written
+    with contextlib.redirect_stdout(output):
+        simulation.run(manager, minutes * 60, on_iteration=on_iteration)
+    publish_count = simulation.broker.publish_count - publishes_before
+
+    # Log throughput, straight into the firmware's logger
+    with contextlib.redirect_stdout(output):
+        log_started = time.perf_counter()
+        for number in range(log_messages):
+            manager.log_to_sd_card("Benchmark message #{}".format(number))
+        manager.logger.flush()
+        log_time = time.perf_counter() - log_started
+
+    results = {
+        "virtual_minutes": minutes,
+        "boot_time_ms": boot_time * 1000,
+        "virtual_boot_time_s": virtual_boot_time,
+        "loop_iteration_us": summarize(iteration_times, 1000000),
+        "loop_blocked_ms": summarize(blocked_times),
+        "command_to_relay_ms": summarize(relay_latencies),
+        "commands_sent": command_count,
+        "commands_lost": len(pending_commands),
+        "publishes_per_minute": publish_count / minutes,
+        "log_messages_per_second": log_messages / log_time if log_time else 0,
+        "sd_bytes_written": simulation.sd_card.bytes_written - sd_bytes_before,
+    }
+    simulation.uninstall()
+    return results
+
+def print_results(results):
+    print("Simulated {virtual_minutes} minutes (boot: {boot_time_ms:.1f}ms real, {virtual_boot_time_s:.2f}s virtual)".format(**results))
+    for name in ("loop_iteration_us", "loop_blocked_ms", "command_to_relay_ms"):
+        stats = results[name]
+        print("{:<22} n={count:<6} mean={mean:8.2f} p50={p50:8.2f} p95={p95:8.2f} max={max:8.2f}".format(name, **stats))
+    print("{:<22} {}/{} lost".format("commands", results["commands_lost"], results["commands_sent"]))
+    print("{:<22} {:.2f}".format("publishes_per_minute", results["publishes_per_minute"]))
+    print("{:<22} {:.0f}".format("log_messages_per_s", results["log_messages_per_second"]))
+    print("{:<22} {}".format("sd_bytes_written", results["sd_bytes_written"]))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark Garage_Manager.loop() in the simulator")
+    parser.add_argument("--minutes", type=float, default=10, help="virtual minutes to simulate")
+    parser.add_argument("--command-interval", type=float, default=30, help="seconds between dashboard commands")
+    parser.add_argument("--log-messages", type=int, default=5000, help="messages for the log throughput test")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.minutes, args.command_interval, args.log_messages, args.seed)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+if __name__ == "__main__":
+    main()
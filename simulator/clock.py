@@ -0,0 +1,55 @@
+# ATMegaZero Simulator - Virtual Clock
+#
+# Replaces time.monotonic() and time.sleep() so the firmware runs in virtual
+# time: sleeping just moves the clock forward. Timers scheduled with call_at()
+# fire while the clock advances, that is how the simulated hardware (doors,
+# broker) reacts "in the background".
+
+import heapq
+import time
+
+class VirtualClock:
+    def __init__(self, start_epoch = None):
+        self.now = 0.0
+        # wall-clock time when the simulation started, used by the fake RTC
+        self.start_epoch = int(time.time()) if start_epoch is None else start_epoch
+        self.timers = []
+        self._timer_sequence = 0
+        self.slept_time = 0.0
+        # time spent inside drivers that sleep while talking to a device
+        self.blocked_time = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def monotonic_ns(self):
+        return int(self.now * 1000000000)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.slept_time += seconds
+            self.advance(seconds)
+
+    # A driver busy-waiting on the hardware, the whole firmware is stuck meanwhile
+    def block(self, seconds):
+        if seconds > 0:
+            self.blocked_time += seconds
+            self.advance(seconds)
+
+    def epoch(self):
+        return self.start_epoch + int(self.now)
+
+    def advance(self, seconds):
+        target = self.now + seconds
+        while self.timers and self.timers[0][0] <= target:
+            when, _, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, when)
+            callback()
+        self.now = target
+
+    def call_at(self, when, callback):
+        self._timer_sequence += 1
+        heapq.heappush(self.timers, (when, self._timer_sequence, callback))
+
+    def call_later(self, delay, callback):
+        self.call_at(self.now + delay, callback)
@@ -0,0 +1,411 @@
+# ATMegaZero Simulator - Hardware
+#
+# Fake versions of the CircuitPython modules and sensor drivers the firmware
+# imports. Every pin is tracked in a shared registry so a benchmark can drive
+# the door switches and watch the relays.
+
+import math
+import random
+import struct
+import time
+import types
+
+class ReloadRequested(BaseException):
+    # Raised by supervisor.reload(), the firmware asked for a soft reboot. Not an
+    # Exception, so the firmware's error handling can't swallow it: on the board
+    # reload() never returns either.
+    pass
+
+class PinState:
+    def __init__(self, name):
+        self.name = name
+        self.value = False
+        self.is_output = False
+        self.listeners = []
+
+    def set(self, value):
+        value = bool(value)
+        changed = value != self.value
+        self.value = value
+        if changed:
+            for listener in self.listeners:
+                listener(self, value)
+
+class Hardware:
+    def __init__(self, clock, seed = 1):
+        self.clock = clock
+        self.pins = {}
+        self.random = random.Random(seed)
+        self.mem_free = 120 * 1024
+        self.ipv4_address = "192.168.1.50"
+        self.wifi_available = True
+
+        # Environment the fake sensors report
+        self.temperature = 22.0 # celsius
+        self.humidity = 45.0
+        self.pressure = 1013.25
+        self.light = 12000
+        self.gas = 30000
+        self.voc_index = 100 # what the SGP40's VOC algorithm settles on
+        self.acceleration = (0.0, 0.0, 9.8)
+        self.gyro = (0.0, 0.0, 0.0)
+        # Door motors shake the accelerometer while they run
+        self.motors_running = 0
+        self.vibration_amplitude = 0.6 # m/s^2
+        self.vibration_frequency = 30 # Hz
+
+    def pin(self, name):
+        state = self.pins.get(name)
+        if state is None:
+            state = PinState(name)
+            self.pins[name] = state
+        return state
+
+    def noise(self, value, amount):
+        return value + self.random.uniform(-amount, amount)
+
+    def build_modules(self):
+        hardware = self
+        clock = self.clock
+        modules = {}
+
+        def module(name, **attributes):
+            m = types.ModuleType(name)
+            for key, value in attributes.items():
+                setattr(m, key, value)
+            modules[name] = m
+            return m
+
+        # board
+        class Pin:
+            def __init__(self, name):
+                self.name = name
+            def __repr__(self):
+                return "board." + self.name
+
+        pin_names = ("A0", "A1", "A2", "D6", "D7", "D8", "D9", "D10", "D12", "D13", "IO5",
+                     "SCL", "SDA", "SCK", "MISO", "MOSI", "SD_CS", "NEOPIXEL")
+        module("board", **{name: Pin(name) for name in pin_names})
+
+        # digitalio
+        class Direction:
+            INPUT = 0
+            OUTPUT = 1
+
+        class Pull:
+            UP = 1
+            DOWN = 2
+
+        class DigitalInOut:
+            def __init__(self, pin):
+                self.state = hardware.pin(pin.name)
+                self._direction = Direction.INPUT
+                self.pull = None
+
+            @property
+            def direction(self):
+                return self._direction
+
+            @direction.setter
+            def direction(self, direction):
+                self._direction = direction
+                self.state.is_output = direction == Direction.OUTPUT
+
+            def switch_to_output(self, value = False, **kwargs):
+                self.direction = Direction.OUTPUT
+                self.state.set(value)
+
+            def switch_to_input(self, pull = None):
+                self.direction = Direction.INPUT
+                self.pull = pull
+
+            @property
+            def value(self):
+                return self.state.value
+
+            @value.setter
+            def value(self, value):
+                self.state.set(value)
+
+            def deinit(self):
+                pass
+
+        module("digitalio", DigitalInOut=DigitalInOut, Direction=Direction, Pull=Pull)
+
+        # busio
+        class I2C:
+            def __init__(self, scl, sda, **kwargs):
+                pass
+            def try_lock(self):
+                return True
+            def unlock(self):
+                pass
+
+        class SPI:
+            def __init__(self, clock, MISO = None, MOSI = None):
+                pass
+
+        module("busio", I2C=I2C, SPI=SPI)
+
+        # neopixel
+        class NeoPixel(list):
+            def __init__(self, pin, n, **kwargs):
+                super().__init__([(0, 0, 0)] * n)
+                self.brightness = kwargs.get("brightness", 1.0)
+            def show(self):
+                pass
+            def fill(self, color):
+                for i in range(len(self)):
+                    self[i] = color
+
+        module("neopixel", NeoPixel=NeoPixel, RGB="RGB", GRB="GRB")
+
+        # storage / adafruit_sdcard / supervisor
+        class VfsFat:
+            def __init__(self, block_device):
+                pass
+
+        module("storage", VfsFat=VfsFat, mount=lambda vfs, path: None, umount=lambda path: None)
+
+        class SDCard:
+            def __init__(self, spi, cs, baudrate = None):
+                pass
+
+        module("adafruit_sdcard", SDCard=SDCard)
+
+        def reload():
+            raise ReloadRequested()
+
+        module("supervisor", reload=reload, ticks_ms=lambda: int(clock.monotonic() * 1000) & 0x3FFFFFFF)
+
+        # wifi / socketpool
+        class Radio:
+            def __init__(self):
+                self.enabled = True
+                self.ipv4_address = None
+
+            def connect(self, ssid, password, **kwargs):
+                if not hardware.wifi_available:
+                    raise ConnectionError("No network with that ssid")
+                self.ipv4_address = hardware.ipv4_address
+
+        radio = Radio()
+        module("wifi", radio=radio)
+
+        class SocketPool:
+            def __init__(self, radio):
+                self.radio = radio
+
+        module("socketpool", SocketPool=SocketPool)
+
+        # Sensor drivers
+        class BME280:
+            def __init__(self, i2c, address = 0x77):
+                self.sea_level_pressure = 1013.25
+
+            @property
+            def temperature(self):
+                return hardware.noise(hardware.temperature, 0.3)
+
+            @property
+            def relative_humidity(self):
+                return hardware.noise(hardware.humidity, 1.0)
+
+            @property
+            def pressure(self):
+                return hardware.noise(hardware.pressure, 0.5)
+
+            @property
+            def altitude(self):
+                return 44330 * (1.0 - (self.pressure / self.sea_level_pressure) ** 0.1903)
+
+        module("adafruit_bme280", Adafruit_BME280_I2C=BME280)
+
+        class DS1307:
+            def __init__(self, i2c):
+                self.offset = 0
+
+            @property
+            def datetime(self):
+                return time.localtime(clock.epoch() + self.offset)
+
+            @datetime.setter
+            def datetime(self, value):
+                self.offset = int(time.mktime(value)) - clock.epoch()
+
+        module("adafruit_ds1307", DS1307=DS1307)
+
+        # Register level MPU6050, only what the FIFO reader uses
+        class MPU6050Device:
+            FIFO_SIZE = 1024
+
+            def __init__(self):
+                self.registers = {}
+                self.fifo = bytearray()
+                self.fifo_time = clock.monotonic()
+                self.selected = 0
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def write(self, buffer, start = 0, end = None):
+                data = bytes(buffer[start:end])
+                self.selected = data[0]
+                if len(data) > 1:
+                    self.registers[data[0]] = data[1]
+                    if data[0] == 0x6A and data[1] & 0x04:
+                        self.fifo = bytearray()
+                        self.fifo_time = clock.monotonic()
+
+            def write_then_readinto(self, out_buffer, in_buffer, out_start = 0, out_end = None, in_start = 0, in_end = None):
+                self.write(out_buffer, out_start, out_end)
+                self.fill_fifo()
+                if in_end is None:
+                    in_end = len(in_buffer)
+                length = in_end - in_start
+                if self.selected == 0x72:
+                    count = min(len(self.fifo), self.FIFO_SIZE)
+                    in_buffer[in_start:in_end] = bytes((count >> 8, count & 0xFF))[:length]
+                elif self.selected == 0x74:
+                    in_buffer[in_start:in_end] = self.fifo[:length]
+                    del self.fifo[:length]
+
+            def fill_fifo(self):
+                if not self.registers.get(0x23, 0) & 0x08 or not self.registers.get(0x6A, 0) & 0x40:
+                    return
+                rate = 1000 / (1 + self.registers.get(0x19, 0))
+                now = clock.monotonic()
+                count = int((now - self.fifo_time) * rate)
+                for i in range(count):
+                    t = self.fifo_time + i / rate
+                    sample = list(hardware.acceleration)
+                    if hardware.motors_running:
+                        shake = hardware.vibration_amplitude * math.sin(2 * math.pi * hardware.vibration_frequency * t)
+                        sample[0] += shake
+                        sample[2] += shake / 2
+                    sample = [int(max(-32768, min(32767, hardware.noise(value, 0.02) * 16384 / 9.80665))) for value in sample]
+                    if len(self.fifo) + 6 <= self.FIFO_SIZE:
+                        self.fifo += struct.pack(">hhh", *sample)
+                    else:
+                        # overflowed, the count reads as the FIFO size
+                        self.fifo += b"\x00" * (self.FIFO_SIZE - len(self.fifo))
+                        break
+                self.fifo_time += count / rate
+
+        class MPU6050:
+            def __init__(self, i2c, address = 0x68):
+                self.address = address
+                self.i2c_device = MPU6050Device()
+
+            @property
+            def acceleration(self):
+                return hardware.acceleration
+
+            @property
+            def gyro(self):
+                return hardware.gyro
+
+        module("adafruit_mpu6050", MPU6050=MPU6050)
+
+        def sgp40_crc(data):
+            crc = 0xFF
+            for byte in data:
+                crc ^= byte
+                for _ in range(8):
+                    crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+            return crc
+
+        # Register level SGP40: a measure command, then the result ~30ms later
+        class SGP40Device:
+            MEASURE_TIME = 0.03
+
+            def __init__(self):
+                self.measure_time = None
+                self.compensation = None
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def write(self, buffer, start = 0, end = None):
+                data = bytes(buffer[start:end])
+                if data[:2] == b"\x26\x0f":
+                    humidity = ((data[2] << 8) | data[3]) * 100 / 65535
+                    temperature = ((data[5] << 8) | data[6]) * 175 / 65535 - 45
+                    self.compensation = (temperature, humidity)
+                    self.measure_time = clock.monotonic()
+
+            def readinto(self, buffer, start = 0, end = None):
+                if self.measure_time is None or clock.monotonic() - self.measure_time < self.MEASURE_TIME:
+                    # the sensor NACKs while it is still measuring
+                    raise OSError(19)
+                self.measure_time = None
+                raw = int(hardware.noise(hardware.gas, 50))
+                word = bytes(((raw >> 8) & 0xFF, raw & 0xFF))
+                buffer[start:start + 3] = word + bytes((sgp40_crc(word),))
+
+        # Like the real driver, the high level API sleeps while the sensor measures
+        class SGP40:
+            BLOCKING_READ_TIME = 0.5
+
+            def __init__(self, i2c, address = 0x59):
+                self.i2c_device = SGP40Device()
+
+            @property
+            def raw(self):
+                # adafruit_sgp40 sleeps between the measure command and the read
+                clock.block(self.BLOCKING_READ_TIME)
+                return int(hardware.noise(hardware.gas, 50))
+
+            def measure_raw(self, temperature = 25, relative_humidity = 50):
+                return self.raw
+
+            def measure_index(self, temperature = 25, relative_humidity = 50):
+                self.measure_raw(temperature, relative_humidity)
+                return max(1, int(hardware.noise(hardware.voc_index, 3)))
+
+        # Stands in for Sensirion's algorithm, it settles on hardware.voc_index
+        class VOCAlgorithm:
+            def vocalgorithm_init(self):
+                self.sample_count = 0
+
+            def vocalgorithm_process(self, sraw):
+                self.sample_count += 1
+                return max(1, int(hardware.noise(hardware.voc_index, 3)))
+
+        sgp40 = module("adafruit_sgp40", SGP40=SGP40)
+        sgp40.__path__ = []
+        sgp40.voc_algorithm = module("adafruit_sgp40.voc_algorithm", VOCAlgorithm=VOCAlgorithm)
+
+        class Mode:
+            CONTINUOUS = 0x0000
+            SINGLE = 0x0100
+
+        class ADS1115:
+            def __init__(self, i2c, **kwargs):
+                self.mode = Mode.SINGLE
+
+        class AnalogIn:
+            def __init__(self, ads, positive_pin, negative_pin = None):
+                self.ads = ads
+
+            @property
+            def value(self):
+                return int(hardware.noise(hardware.light, 40))
+
+            @property
+            def voltage(self):
+                return self.value * 4.096 / 32767
+
+        ads1x15 = module("adafruit_ads1x15")
+        ads1x15.__path__ = []
+        ads1x15.ads1115 = module("adafruit_ads1x15.ads1115", ADS1115=ADS1115, P0=0, P1=1, P2=2, P3=3)
+        ads1x15.ads1x15 = module("adafruit_ads1x15.ads1x15", Mode=Mode)
+        ads1x15.analog_in = module("adafruit_ads1x15.analog_in", AnalogIn=AnalogIn)
+
+        return modules
@@ -0,0 +1,126 @@
+# ATMegaZero Simulator - MQTT
+#
+# An in-process stand-in for the Adafruit IO MQTT broker and a MiniMQTT
+# compatible client. The broker keeps the last value of every feed, expands
+# group publishes into their feeds and answers "<feed>/get" requests the same
+# way Adafruit IO does.
+
+import json
+
+class FakeBroker:
+    def __init__(self, clock):
+        self.clock = clock
+        self.online = True
+        self.clients = []
+        self.last_values = {}
+        # (virtual time, topic, payload) of every message the firmware published
+        self.published = []
+        # number of publish calls, a group publish counts as one
+        self.publish_count = 0
+        self.connect_count = 0
+
+    def check_online(self):
+        if not self.online:
+            raise OSError("broker unreachable")
+
+    def connect(self, client):
+        self.check_online()
+        self.connect_count += 1
+        if client not in self.clients:
+            self.clients.append(client)
+
+    def disconnect(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def publish(self, topic, payload):
+        self.check_online()
+        self.publish_count += 1
+        self.published.append((self.clock.monotonic(), topic, payload))
+
+        if topic.endswith("/get"):
+            feed = topic[:-4]
+            if feed in self.last_values:
+                self.deliver(feed, self.last_values[feed])
+            return
+
+        if "/groups/" in topic:
+            # username/groups/garagegroup {"feeds": {...}} -> username/feeds/garagegroup.key
+            username, group = topic.split("/groups/")
+            for key, value in json.loads(payload)["feeds"].items():
+                self.last_values["{}/feeds/{}.{}".format(username, group, key)] = str(value)
+            return
+
+        self.last_values[topic] = str(payload)
+
+    # A message coming from the dashboard
+    def inject(self, topic, message):
+        self.last_values[topic] = message
+        self.deliver(topic, message)
+
+    def deliver(self, topic, message):
+        for client in self.clients:
+            if topic in client.subscriptions:
+                client.pending.append((topic, message))
+
+    def messages_for(self, topic):
+        return [payload for _, published_topic, payload in self.published if published_topic == topic]
+
+class MMQTTException(Exception):
+    pass
+
+# Same surface as adafruit_minimqtt.adafruit_minimqtt.MQTT for what the firmware uses
+class MQTT:
+    broker_instance = None
+
+    def __init__(self, broker = None, port = None, username = None, password = None,
+                 socket_pool = None, ssl_context = None, **kwargs):
+        self.broker = MQTT.broker_instance
+        self.username = username
+        self.subscriptions = []
+        self.pending = []
+        self.is_connected_flag = False
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_subscribe = None
+
+    def connect(self, *args, **kwargs):
+        self.broker.connect(self)
+        self.is_connected_flag = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, 0, 0)
+
+    def disconnect(self):
+        self.broker.disconnect(self)
+        self.is_connected_flag = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+
+    def is_connected(self):
+        if not self.is_connected_flag:
+            raise MMQTTException("MiniMQTT is not connected")
+        return True
+
+    def subscribe(self, topic, qos = 0):
+        self.is_connected()
+        if topic not in self.subscriptions:
+            self.subscriptions.append(topic)
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, None, topic, qos)
+
+    def unsubscribe(self, topic):
+        if topic in self.subscriptions:
+            self.subscriptions.remove(topic)
+
+    def publish(self, topic, msg, retain = False, qos = 0):
+        self.is_connected()
+        self.broker.publish(topic, msg)
+
+    def loop(self, timeout = 0):
+        self.is_connected()
+        self.broker.check_online()
+        while self.pending:
+            topic, message = self.pending.pop(0)
+            if self.on_message is not None:
+                self.on_message(self, topic, message)
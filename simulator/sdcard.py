@@ -0,0 +1,80 @@
+# ATMegaZero Simulator - SD Card
+#
+# The firmware reads and writes files under /sd. On the host those paths are
+# redirected to a regular directory so nothing needs to exist at /sd.
+
+import builtins
+import os
+
+SD_MOUNT_POINT = "/sd"
+
+class SDCardRedirect:
+    def __init__(self, root):
+        self.root = root
+        self.bytes_written = 0
+        self._original = {}
+
+    def map_path(self, path):
+        if isinstance(path, str) and (path == SD_MOUNT_POINT or path.startswith(SD_MOUNT_POINT + "/")):
+            return os.path.join(self.root, path[len(SD_MOUNT_POINT) + 1:])
+        return path
+
+    def install(self):
+        os.makedirs(self.root, exist_ok=True)
+        self._original = {
+            "open": builtins.open,
+            "stat": os.stat,
+            "remove": os.remove,
+            "rename": os.rename,
+            "listdir": os.listdir,
+            "mkdir": os.mkdir,
+        }
+        original = self._original
+        redirect = self
+
+        class CountingFile:
+            # Wraps a file opened on the card to keep track of the bytes written
+            def __init__(self, f):
+                self._file = f
+
+            def write(self, data):
+                redirect.bytes_written += len(data)
+                return self._file.write(data)
+
+            def __getattr__(self, name):
+                return getattr(self._file, name)
+
+            def __iter__(self):
+                return iter(self._file)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                self._file.close()
+                return False
+
+        def sd_open(path, *args, **kwargs):
+            mapped = redirect.map_path(path)
+            f = original["open"](mapped, *args, **kwargs)
+            if mapped is not path:
+                return CountingFile(f)
+            return f
+
+        builtins.open = sd_open
+        os.stat = lambda path, *a, **k: original["stat"](self.map_path(path), *a, **k)
+        os.remove = lambda path, *a, **k: original["remove"](self.map_path(path), *a, **k)
+        os.rename = lambda src, dst, *a, **k: original["rename"](self.map_path(src), self.map_path(dst), *a, **k)
+        os.listdir = lambda path = ".": original["listdir"](self.map_path(path))
+        os.mkdir = lambda path, *a, **k: original["mkdir"](self.map_path(path), *a, **k)
+
+    def uninstall(self):
+        if not self._original:
+            return
+        builtins.open = self._original["open"]
+        os.stat = self._original["stat"]
+        os.remove = self._original["remove"]
+        os.rename = self._original["rename"]
+        os.listdir = self._original["listdir"]
+        os.mkdir = self._original["mkdir"]
+        self._original = {}
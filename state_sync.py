@@ -0,0 +1,91 @@
+# ATMegaZero State Sync
+#
+# Keeps the settings that live on adafruit.io (auto close, ...) in sync with the
+# board over the MQTT session we already have. Only sync feeds that hold a value:
+# the answer is handled like any other message on the feed, a momentary button
+# would be pressed again.
+# Publishing to "<feed>/get" makes adafruit.io send the feed's last value to our
+# subscription, the first message on that topic is the answer. Feeds that don't
+# answer within `timeout` seconds keep the value saved on the SD card the last
+# time it changed, so the board boots with sensible settings even offline.
+# Changes are written to the card by update(), never while handling a message.
+# Values that are never requested (local state) are simply saved with set().
+#
+# For full documentation please visit https://atmegazero.com
+
+import json
+import time
+from log import get_logger
+
+log = get_logger("state")
+
+class StateSync:
+    def __init__(self, path, timeout = 5):
+        self.path = path
+        self.timeout = timeout
+        self.values = {} # topic -> last known value
+        self.pending = {} # topic -> time the value was requested
+        self.is_dirty = False
+        self.load()
+
+    def get(self, topic, default = None):
+        return self.values.get(topic, default)
+
+    # Remembers the value, it is saved on the SD card by the next update()
+    def set(self, topic, value):
+        if self.values.get(topic) == value:
+            return
+        self.values[topic] = value
+        self.is_dirty = True
+
+    # Asks adafruit.io for the last value of every topic. The client must already
+    # be subscribed to them.
+    def request(self, client, topics, now = None):
+        if now is None:
+            now = time.monotonic()
+        for topic in topics:
+            client.publish(topic + "/get", "")
+            self.pending[topic] = now
+
+    def is_pending(self, topic):
+        return topic in self.pending
+
+    def received(self, topic, value):
+        self.pending.pop(topic, None)
+        self.set(topic, value)
+
+    # Call this periodically. Saves the changed values and returns the topics that
+    # didn't answer in time, they keep their saved value.
+    def update(self, now = None):
+        self.flush()
+        if not self.pending:
+            return []
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        for topic, requested_time in self.pending.items():
+            if now - requested_time >= self.timeout:
+                expired.append(topic)
+        for topic in expired:
+            del self.pending[topic]
+        return expired
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.values = json.load(f)
+        except (OSError, ValueError):
+            # first boot or a corrupted file, start with the defaults
+            self.values = {}
+
+    def flush(self):
+        if self.is_dirty:
+            self.save()
+
+    def save(self):
+        self.is_dirty = False
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.values, f)
+        except Exception as e:
+            log.error("Error saving the state on the SD Card: %s", e)
@@ -0,0 +1,147 @@
+# ATMegaZero Telemetry Queue
+#
+# Store-and-forward queue on the SD card for the telemetry we couldn't publish
+# (no Wi-Fi, broker down, ...). Every sample or door event is a fixed size
+# binary record: timestamp (uint32, seconds), feed id (uint8), value (float32).
+# Records are appended to the end of the file and replayed oldest first once the
+# MQTT session is back. The file starts with a small header holding the index of
+# the next record to replay and the number of records written, so a reboot
+# doesn't replay (or lose) anything.
+#
+# The queue holds at most `max_records`, when it is full the oldest records are
+# evicted in batches of `eviction_batch`.
+#
+# For full documentation please visit https://atmegazero.com
+
+import struct
+from log import get_logger
+
+log = get_logger("telemetry")
+
+HEADER_FORMAT = "<II" # index of the next record to replay, number of records written
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = "<IBf" # timestamp, feed id, value
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+class TelemetryQueue:
+    def __init__(self, path, feeds, max_records = 20000, eviction_batch = 1000):
+        self.path = path
+        # the feed id stored in each record is the index in this list
+        self.feeds = feeds
+        self.feed_ids = {}
+        for index, feed in enumerate(feeds):
+            self.feed_ids[feed] = index
+        self.max_records = max_records
+        self.eviction_batch = min(eviction_batch, max_records)
+
+        self.read_index = 0
+        self.write_index = 0
+        self.evicted_count = 0
+        self.record = bytearray(RECORD_SIZE)
+        self.header = bytearray(HEADER_SIZE)
+        self._load()
+
+    def __len__(self):
+        return self.write_index - self.read_index
+
+    def push(self, feed, value, timestamp):
+        feed_id = self.feed_ids.get(feed)
+        if feed_id is None:
+            return False
+
+        try:
+            if self.write_index >= self.max_records:
+                self._evict()
+
+            struct.pack_into(RECORD_FORMAT, self.record, 0, timestamp, feed_id, value)
+            with open(self.path, "r+b") as f:
+                f.seek(HEADER_SIZE + self.write_index * RECORD_SIZE)
+                f.write(self.record)
+                self.write_index += 1
+                self._write_header(f)
+            return True
+        except Exception as e:
+            log.error("Error queuing telemetry on the SD Card: %s", e)
+            return False
+
+    # Returns up to `count` of the oldest records as (timestamp, feed, value), they
+    # stay in the queue until commit() is called. Every record read is returned, so
+    # the caller can commit by position: the feed is None when its id is no longer
+    # in `feeds` (e.g. a door was removed), skip those.
+    def peek(self, count):
+        count = min(count, len(self))
+        if count <= 0:
+            return []
+
+        with open(self.path, "rb") as f:
+            f.seek(HEADER_SIZE + self.read_index * RECORD_SIZE)
+            data = f.read(count * RECORD_SIZE)
+
+        records = []
+        for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            timestamp, feed_id, value = struct.unpack_from(RECORD_FORMAT, data, offset)
+            feed = self.feeds[feed_id] if feed_id < len(self.feeds) else None
+            records.append((timestamp, feed, value))
+        return records
+
+    # Drops the `count` oldest records once they were published
+    def commit(self, count):
+        self.read_index = min(self.read_index + count, self.write_index)
+        if self.read_index == self.write_index:
+            # everything was replayed, start over with an empty file
+            self._reset()
+        else:
+            try:
+                with open(self.path, "r+b") as f:
+                    self._write_header(f)
+            except Exception as e:
+                log.error("Error updating the telemetry queue on the SD Card: %s", e)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                self.read_index, self.write_index = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+            if self.read_index > self.write_index or self.write_index > self.max_records:
+                raise ValueError("corrupted telemetry queue header")
+        except Exception:
+            self._reset()
+
+    def _reset(self):
+        self.read_index = 0
+        self.write_index = 0
+        try:
+            with open(self.path, "wb") as f:
+                self._write_header(f)
+        except Exception as e:
+            log.error("Error creating the telemetry queue on the SD Card: %s", e)
+
+    def _write_header(self, f):
+        struct.pack_into(HEADER_FORMAT, self.header, 0, self.read_index, self.write_index)
+        f.seek(0)
+        f.write(self.header)
+
+    def _evict(self):
+        # The records before read_index were already replayed, reuse that space.
+        # Only when there is none, drop the oldest records that weren't sent.
+        dropped = 0
+        if self.read_index == 0:
+            dropped = min(len(self), self.eviction_batch)
+            self.evicted_count += dropped
+            log.warning("Telemetry queue is full, dropping the %d oldest records", dropped)
+
+        # Move the records that are left to the front of the file
+        first = self.read_index + dropped
+        remaining = self.write_index - first
+        with open(self.path, "r+b") as f:
+            moved = 0
+            while moved < remaining:
+                count = min(64, remaining - moved)
+                f.seek(HEADER_SIZE + (first + moved) * RECORD_SIZE)
+                data = f.read(count * RECORD_SIZE)
+                f.seek(HEADER_SIZE + moved * RECORD_SIZE)
+                f.write(data)
+                moved += count
+
+            self.read_index = 0
+            self.write_index = remaining
+            self._write_header(f)
@@ -0,0 +1,376 @@
+# ATMegaZero Time Series Store
+#
+# Keeps the sensor history on the SD card so weeks of it can be looked at without
+# the cloud. Every sample is a fixed size binary record:
+#   timestamp (uint32), temperature, humidity, pressure, brightness, VOC index (float32),
+#   door states (uint16, 4 bits per door)
+# Samples are appended to one segment per day (/sd/history/20261018-v2.raw). Next to
+# it a tiny index (.idx) holds, for every hour of the day, the position of its
+# first sample and of its first minute rollup. The min/max/avg of every minute
+# (.min) and of every hour (.hr) are written as soon as that minute or hour is
+# over, so a query over weeks only reads ~24 hour records per day and a query
+# over an hour seeks straight to it. Records are read in blocks into a
+# preallocated buffer, nothing is parsed line by line.
+#
+# Missing readings are stored as NaN. The minute and hour in progress are rebuilt
+# from the card after a reboot, and segments older than `max_days` are deleted.
+# FORMAT_VERSION is part of every file name: bump it whenever FIELDS or a record
+# layout changes, segments of another version are then never read (only pruned).
+# Version 1 stored the raw SGP40 ticks ("gas") where version 2 has the VOC index.
+#
+# For full documentation please visit https://atmegazero.com
+
+import os
+import struct
+import time
+from log import get_logger
+
+log = get_logger("history")
+
+FORMAT_VERSION = 2
+FIELDS = ("temperature", "humidity", "pressure", "brightness", "voc")
+FIELD_COUNT = len(FIELDS)
+
+RECORD_FORMAT = "<I5fH" # timestamp, readings, door states
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+# period start, sample count, doors that were opened (1 bit per door), minimums, maximums, averages
+ROLLUP_FORMAT = "<IHB15f"
+ROLLUP_SIZE = struct.calcsize(ROLLUP_FORMAT)
+# (first sample, first minute rollup) of every hour of the day
+INDEX_FORMAT = "<48I"
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+NO_RECORD = 0xFFFFFFFF
+
+DOOR_STATE_BITS = 4
+MAX_DOORS = 4
+SECONDS_PER_DAY = 24 * 60 * 60
+READ_BLOCK_RECORDS = 32 # records read from the card at once
+NAN = float("nan")
+
+class History_Resolution:
+    raw = 0
+    minute = 1
+    hour = 2
+    def __init__(self, resolution):
+        assert resolution in (self.raw, self.minute, self.hour)
+        self.selection = resolution
+
+SEGMENT_EXTENSIONS = (".raw", ".min", ".hr")
+INDEX_EXTENSION = ".idx"
+
+# 20261018
+def get_day_name(timestamp):
+    t = time.localtime(timestamp)
+    return "{:04}{:02}{:02}".format(t.tm_year, t.tm_mon, t.tm_mday)
+
+def get_day_start(timestamp):
+    t = time.localtime(timestamp)
+    return timestamp - (t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec)
+
+def pack_door_states(states):
+    packed = 0
+    for index in range(min(len(states), MAX_DOORS)):
+        packed |= (states[index] & 0xF) << (index * DOOR_STATE_BITS)
+    return packed
+
+def unpack_door_states(packed, door_count):
+    return [(packed >> (index * DOOR_STATE_BITS)) & 0xF for index in range(door_count)]
+
+# One bit per door that isn't closed (state 0)
+def get_doors_opened_mask(packed):
+    mask = 0
+    for index in range(MAX_DOORS):
+        if (packed >> (index * DOOR_STATE_BITS)) & 0xF:
+            mask |= 1 << index
+    return mask
+
+# min/max/avg of every field over a minute or an hour
+class Rollup:
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, start):
+        self.start = start
+        self.count = 0
+        self.doors_opened = 0
+        self.minimums = [NAN] * FIELD_COUNT
+        self.maximums = [NAN] * FIELD_COUNT
+        self.sums = [0.0] * FIELD_COUNT
+        self.weights = [0] * FIELD_COUNT
+
+    # Adds a sample, or a smaller rollup when `minimums` and `maximums` are given
+    # (values are then its averages and count its number of samples)
+    def add(self, values, doors_opened, count = 1, minimums = None, maximums = None):
+        self.count += count
+        self.doors_opened |= doors_opened
+        for i in range(FIELD_COUNT):
+            value = values[i]
+            if value != value:
+                # NaN, the sensor had no reading
+                continue
+            low = value if minimums is None else minimums[i]
+            high = value if maximums is None else maximums[i]
+            # comparisons with NaN are False, so the first value always goes in
+            if not low >= self.minimums[i]:
+                self.minimums[i] = low
+            if not high <= self.maximums[i]:
+                self.maximums[i] = high
+            self.sums[i] += value * count
+            self.weights[i] += count
+
+    def averages(self):
+        return [self.sums[i] / self.weights[i] if self.weights[i] else NAN for i in range(FIELD_COUNT)]
+
+    def pack_into(self, buffer):
+        fields = self.minimums + self.maximums + self.averages()
+        struct.pack_into(ROLLUP_FORMAT, buffer, 0, self.start, min(self.count, 0xFFFF), self.doors_opened, *fields)
+
+def unpack_rollup(buffer, offset = 0):
+    record = struct.unpack_from(ROLLUP_FORMAT, buffer, offset)
+    return (record[0], record[1], record[2],
+            record[3:3 + FIELD_COUNT], record[3 + FIELD_COUNT:3 + 2 * FIELD_COUNT], record[3 + 2 * FIELD_COUNT:])
+
+class TimeSeriesStore:
+    def __init__(self, path, door_count = 0, max_days = 90):
+        self.path = path
+        self.door_count = min(door_count, MAX_DOORS)
+        self.max_days = max_days
+
+        self.day = None # name of the day the segments below belong to
+        self.day_start = 0
+        self.day_end = 0
+        self.counts = [0, 0, 0] # records in the .raw, .min and .hr segments
+        self.index = [NO_RECORD] * 48
+        self.last_timestamp = 0
+
+        self.minute = Rollup()
+        self.hour = Rollup()
+        self.record = bytearray(RECORD_SIZE)
+        self.rollup = bytearray(ROLLUP_SIZE)
+        self.read_buffer = bytearray(READ_BLOCK_RECORDS * ROLLUP_SIZE)
+
+        try:
+            os.mkdir(path)
+        except OSError:
+            # already there
+            pass
+
+    # values are in FIELDS order (NaN when missing), door_states are the Door_State of each door
+    def append(self, timestamp, values, door_states = ()):
+        try:
+            self._append(timestamp, values, pack_door_states(door_states))
+            return True
+        except Exception as e:
+            log.error("Error writing the history on the SD Card: %s", e)
+            return False
+
+    # Yields the records between start and end (epoch seconds, inclusive), oldest first:
+    #   raw:          (timestamp, values, door states)
+    #   minute, hour: (start, sample count, doors opened mask, minimums, maximums, averages)
+    # The minute and hour in progress aren't on the card yet.
+    def iter_records(self, start, end, resolution = History_Resolution.hour):
+        day_start = get_day_start(start)
+        while day_start <= end:
+            day = get_day_name(day_start)
+            position = self._get_first_position(day, day_start, start, resolution)
+            if position is not None:
+                records = self._read_segment(day, resolution, position)
+                try:
+                    for record in records:
+                        if record[0] > end:
+                            return
+                        if record[0] >= start:
+                            yield record
+                finally:
+                    # closes the segment file right away
+                    records.close()
+            # step over days that are 23 or 25 hours long
+            day_start = get_day_start(day_start + SECONDS_PER_DAY + 3600)
+
+    # (min, max, avg) of a field between start and end, None when there is no data
+    def get_stats(self, field, start, end, resolution = History_Resolution.hour):
+        i = FIELDS.index(field)
+        rollup = Rollup()
+        for record in self.iter_records(start, end, resolution):
+            if resolution == History_Resolution.raw:
+                rollup.add(record[1], 0)
+            else:
+                rollup.add(record[5], 0, record[1], record[3], record[4])
+        if rollup.weights[i] == 0:
+            return None
+        return (rollup.minimums[i], rollup.maximums[i], rollup.averages()[i])
+
+    def get_segment_path(self, day, extension):
+        return "{}/{}-v{}{}".format(self.path, day, FORMAT_VERSION, extension)
+
+    def _append(self, timestamp, values, door_states):
+        if self.day is None:
+            self._resume(timestamp)
+
+        # the RTC resync can step the clock back a little, keep the segments sorted
+        timestamp = max(timestamp, self.last_timestamp)
+        minute_start = timestamp - timestamp % 60
+        hour_start = timestamp - timestamp % 3600
+        if self.minute.start is not None and self.minute.start != minute_start:
+            self._close_minute()
+        if self.hour.start is not None and self.hour.start != hour_start:
+            self._close_hour()
+        if not self.day_start <= timestamp < self.day_end:
+            self._open_day(get_day_start(timestamp))
+
+        if self.hour.start is None:
+            self.hour.reset(hour_start)
+            hour = (hour_start - self.day_start) // 3600
+            if self.index[hour * 2] == NO_RECORD:
+                self.index[hour * 2] = self.counts[History_Resolution.raw]
+                self.index[hour * 2 + 1] = self.counts[History_Resolution.minute]
+                self._write_index()
+        if self.minute.start is None:
+            self.minute.reset(minute_start)
+
+        struct.pack_into(RECORD_FORMAT, self.record, 0, timestamp,
+                         values[0], values[1], values[2], values[3], values[4], door_states)
+        self._write_record(History_Resolution.raw, self.record)
+        self.minute.add(values, get_doors_opened_mask(door_states))
+        self.last_timestamp = timestamp
+
+    def _close_minute(self):
+        minute = self.minute
+        minute.pack_into(self.rollup)
+        self._write_record(History_Resolution.minute, self.rollup)
+        self.hour.add(minute.averages(), minute.doors_opened, minute.count, minute.minimums, minute.maximums)
+        minute.reset(None)
+
+    def _close_hour(self):
+        self.hour.pack_into(self.rollup)
+        self._write_record(History_Resolution.hour, self.rollup)
+        self.hour.reset(None)
+
+    def _open_day(self, day_start):
+        self.day = get_day_name(day_start)
+        self.day_start = day_start
+        self.day_end = get_day_start(day_start + SECONDS_PER_DAY + 3600)
+        for resolution in range(len(SEGMENT_EXTENSIONS)):
+            size = RECORD_SIZE if resolution == History_Resolution.raw else ROLLUP_SIZE
+            try:
+                # a record cut short by a reset is overwritten by the next one
+                self.counts[resolution] = os.stat(self.get_segment_path(self.day, SEGMENT_EXTENSIONS[resolution]))[6] // size
+            except OSError:
+                self.counts[resolution] = 0
+        self.index = self._read_index(self.day)
+        self._prune(day_start)
+
+    # Picks up where we were before the reboot: the minute and hour of the last
+    # sample on the card weren't written yet, rebuild them from the segments.
+    def _resume(self, timestamp):
+        latest = None
+        index_suffix = "-v{}{}".format(FORMAT_VERSION, INDEX_EXTENSION)
+        try:
+            for name in os.listdir(self.path):
+                if name.endswith(index_suffix) and (latest is None or name > latest):
+                    latest = name
+        except OSError:
+            pass
+        if latest is None:
+            self._open_day(get_day_start(timestamp))
+            return
+
+        self._open_day(int(time.mktime((int(latest[0:4]), int(latest[4:6]), int(latest[6:8]), 0, 0, 0, 0, -1, -1))))
+        hour = 23
+        while hour >= 0 and self.index[hour * 2] == NO_RECORD:
+            hour -= 1
+        if hour < 0:
+            return
+
+        hour_start = self.day_start + hour * 3600
+        last_hour = self._get_last_record(History_Resolution.hour)
+        if last_hour is not None and last_hour[0] >= hour_start:
+            return
+
+        self.hour.reset(hour_start)
+        last_minute_end = hour_start
+        for record in self._read_segment(self.day, History_Resolution.minute, self.index[hour * 2 + 1]):
+            self.hour.add(record[5], record[2], record[1], record[3], record[4])
+            last_minute_end = record[0] + 60
+        for timestamp, values, door_states in self._read_segment(self.day, History_Resolution.raw, self.index[hour * 2]):
+            if timestamp < last_minute_end:
+                continue
+            if self.minute.start is None:
+                self.minute.reset(timestamp - timestamp % 60)
+            self.minute.add(values, get_doors_opened_mask(pack_door_states(door_states)))
+            self.last_timestamp = timestamp
+        log.info("Resumed the history of %s at %02d:00", self.day, hour)
+
+    def _get_first_position(self, day, day_start, start, resolution):
+        if resolution == History_Resolution.hour:
+            return 0
+        index = self.index if day == self.day else self._read_index(day)
+        hour = max(0, (start - day_start) // 3600)
+        while hour < 24:
+            position = index[hour * 2 + resolution]
+            if position != NO_RECORD:
+                return position
+            hour += 1
+        return None
+
+    def _get_last_record(self, resolution):
+        count = self.counts[resolution]
+        if count == 0:
+            return None
+        last = None
+        for record in self._read_segment(self.day, resolution, count - 1):
+            last = record
+        return last
+
+    def _read_segment(self, day, resolution, position):
+        size = RECORD_SIZE if resolution == History_Resolution.raw else ROLLUP_SIZE
+        buffer = self.read_buffer
+        try:
+            f = open(self.get_segment_path(day, SEGMENT_EXTENSIONS[resolution]), "rb")
+        except OSError:
+            return
+        with f:
+            f.seek(position * size)
+            block = memoryview(buffer)[:READ_BLOCK_RECORDS * size]
+            while True:
+                length = f.readinto(block)
+                if not length:
+                    return
+                for offset in range(0, length - size + 1, size):
+                    if resolution == History_Resolution.raw:
+                        record = struct.unpack_from(RECORD_FORMAT, buffer, offset)
+                        yield (record[0], record[1:1 + FIELD_COUNT], unpack_door_states(record[-1], self.door_count))
+                    else:
+                        yield unpack_rollup(buffer, offset)
+                if length < len(block):
+                    return
+
+    def _write_record(self, resolution, record):
+        path = self.get_segment_path(self.day, SEGMENT_EXTENSIONS[resolution])
+        count = self.counts[resolution]
+        with open(path, "r+b" if count > 0 else "wb") as f:
+            f.seek(count * len(record))
+            f.write(record)
+        self.counts[resolution] = count + 1
+
+    def _read_index(self, day):
+        try:
+            with open(self.get_segment_path(day, INDEX_EXTENSION), "rb") as f:
+                return list(struct.unpack(INDEX_FORMAT, f.read(INDEX_SIZE)))
+        except Exception:
+            # no samples that day yet, or a corrupted index
+            return [NO_RECORD] * 48
+
+    def _write_index(self):
+        with open(self.get_segment_path(self.day, INDEX_EXTENSION), "wb") as f:
+            f.write(struct.pack(INDEX_FORMAT, *self.index))
+
+    def _prune(self, day_start):
+        oldest = get_day_name(day_start - self.max_days * SECONDS_PER_DAY)
+        try:
+            for name in os.listdir(self.path):
+                if name[:8] < oldest:
+                    os.remove("{}/{}".format(self.path, name))
+                    log.info("Deleted old history segment %s", name)
+        except OSError as e:
+            log.warning("Error pruning the history: %s", e)
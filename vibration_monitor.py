@@ -0,0 +1,241 @@
+# ATMegaZero Vibration Monitor
+#
+# Tells when a garage door motor is running from the vibration it makes. That
+# usually shows up a fraction of a second after the relay is pulsed, long before
+# the magnetic switch changes, and it also shows when the motor stops too early
+# (a jam) or starts without a command (the wall button or a remote).
+#
+# The MPU6050 samples its accelerometer at SAMPLE_RATE into its own 1KB FIFO.
+# update() empties the FIFO with one burst read into a preallocated buffer. The
+# last WINDOW_SIZE samples are then analysed with ulab (numpy on a computer)
+# instead of a loop over every sample:
+#   - rms: the RMS of the acceleration once gravity (the mean of each axis) is removed
+#   - band: the share of that energy that falls inside MOTOR_BAND (FFT of each axis)
+# The motor is running once both stay above their thresholds for `start_time`
+# seconds, and stopped once they stay below them for `stop_time` seconds.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+from log import get_logger
+
+# ulab ships with CircuitPython on most boards. Without it (or numpy) there is
+# no vibration monitoring, see is_supported().
+try:
+    from ulab import numpy as np
+except ImportError:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+log = get_logger("vibration")
+
+# MPU6050 registers
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+ACCEL_CONFIG = 0x1C
+FIFO_EN = 0x23
+USER_CTRL = 0x6A
+FIFO_COUNT_H = 0x72
+FIFO_R_W = 0x74
+
+ACCEL_FIFO_EN = 0x08
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+DLPF_94_HZ = 2 # the sample rate is 1kHz / (1 + SMPLRT_DIV) with the filter on
+ACCEL_RANGE_2_G = 0x00
+ACCEL_SCALE = 9.80665 / 16384 # m/s^2 per LSB at +-2g
+
+FIFO_SIZE = 1024 # bytes
+SAMPLE_SIZE = 6 # x, y, z as big endian int16
+
+SAMPLE_RATE = 200 # Hz
+WINDOW_SIZE = 64 # samples (320ms at 200Hz), must be a power of 2 for the FFT
+MOTOR_BAND = (15, 60) # Hz
+RMS_THRESHOLD = 0.15 # m/s^2
+BAND_THRESHOLD = 0.4 # share of the energy in MOTOR_BAND
+START_TIME = 0.2 # seconds
+STOP_TIME = 1.0 # seconds
+
+def is_supported():
+    return np is not None
+
+# |FFT|^2 of a real signal
+def get_power_spectrum(signal):
+    spectrum = np.fft.fft(signal)
+    if isinstance(spectrum, tuple):
+        # ulab built without complex numbers returns (real, imaginary)
+        real, imaginary = spectrum
+    else:
+        real, imaginary = np.real(spectrum), np.imag(spectrum)
+    return real * real + imaginary * imaginary
+
+# Accelerometer samples from the MPU6050 FIFO, read over the driver's i2c_device
+class MPU6050_FIFO:
+    def __init__(self, i2c_device, sample_rate = SAMPLE_RATE):
+        self.i2c_device = i2c_device
+        self.sample_rate = sample_rate
+        self.buffer = bytearray(FIFO_SIZE)
+        self.command = bytearray(2)
+        self.register = bytearray(1)
+        self.count = bytearray(2)
+        self.overflow_count = 0
+
+    def start(self):
+        self._write_register(CONFIG, DLPF_94_HZ)
+        self._write_register(SMPLRT_DIV, 1000 // self.sample_rate - 1)
+        self._write_register(ACCEL_CONFIG, ACCEL_RANGE_2_G)
+        self._write_register(FIFO_EN, ACCEL_FIFO_EN)
+        self.reset()
+
+    def stop(self):
+        self._write_register(FIFO_EN, 0)
+        self._write_register(USER_CTRL, 0)
+
+    def reset(self):
+        self._write_register(USER_CTRL, USER_CTRL_FIFO_EN | USER_CTRL_FIFO_RESET)
+
+    # Reads every complete sample in the FIFO into `buffer`, returns the number of bytes
+    def read(self):
+        self.register[0] = FIFO_COUNT_H
+        with self.i2c_device as i2c:
+            i2c.write_then_readinto(self.register, self.count)
+        length = (self.count[0] << 8) | self.count[1]
+        if length >= FIFO_SIZE:
+            # we fell behind and samples were dropped, start over with a clean FIFO
+            self.overflow_count += 1
+            self.reset()
+            return 0
+
+        length -= length % SAMPLE_SIZE
+        if length > 0:
+            self.register[0] = FIFO_R_W
+            with self.i2c_device as i2c:
+                i2c.write_then_readinto(self.register, self.buffer, in_end=length)
+        return length
+
+    def _write_register(self, register, value):
+        self.command[0] = register
+        self.command[1] = value
+        with self.i2c_device as i2c:
+            i2c.write(self.command)
+
+# Decides whether the motor is running from a sliding window of samples
+class VibrationDetector:
+    def __init__(self, sample_rate = SAMPLE_RATE, window_size = WINDOW_SIZE, band = MOTOR_BAND,
+                 rms_threshold = RMS_THRESHOLD, band_threshold = BAND_THRESHOLD,
+                 start_time = START_TIME, stop_time = STOP_TIME):
+        self.window_size = window_size
+        # the last samples of each axis, m/s^2
+        self.windows = [np.zeros(window_size), np.zeros(window_size), np.zeros(window_size)]
+        self.filled = 0
+        # FFT bins of the motor band
+        self.band_start = max(1, int(band[0] * window_size / sample_rate))
+        self.band_end = min(window_size // 2, int(band[1] * window_size / sample_rate) + 1)
+        self.rms_threshold = rms_threshold
+        self.band_threshold = band_threshold
+        self.start_time = start_time
+        self.stop_time = stop_time
+
+        self.is_running = False
+        self.changed_since = None # when the readings started disagreeing with is_running
+        self.rms = 0
+        self.band_fraction = 0
+        self.peak_rms = 0
+        # Called with (detector, is_running) when the motor starts or stops
+        self.on_change = None
+
+    # `buffer` holds `length` bytes of big endian (x, y, z) int16 samples
+    def add(self, buffer, length, now):
+        count = length // SAMPLE_SIZE
+        if count == 0:
+            return
+        # the FIFO is big endian, the board is little endian
+        raw = np.frombuffer(buffer, dtype=np.int16, count=count * 3).byteswap()
+        size = self.window_size
+        for axis in range(3):
+            samples = raw[axis::3] * ACCEL_SCALE
+            window = self.windows[axis]
+            if count >= size:
+                window[:] = samples[count - size:]
+            else:
+                window[:size - count] = window[count:]
+                window[size - count:] = samples
+        self.filled = min(self.filled + count, size)
+        if self.filled == size:
+            self._analyse(now)
+
+    def reset(self):
+        self.filled = 0
+
+    def _analyse(self, now):
+        energy = 0
+        band_energy = 0
+        total = 0
+        for window in self.windows:
+            dynamic = window - np.mean(window)
+            energy += float(np.sum(dynamic * dynamic))
+            spectrum = get_power_spectrum(dynamic)
+            total += float(np.sum(spectrum[1:self.window_size // 2]))
+            band_energy += float(np.sum(spectrum[self.band_start:self.band_end]))
+        self.rms = (energy / self.window_size) ** 0.5
+        self.band_fraction = band_energy / total if total > 0 else 0
+        if self.rms > self.peak_rms:
+            self.peak_rms = self.rms
+
+        is_vibrating = self.rms >= self.rms_threshold and self.band_fraction >= self.band_threshold
+        if is_vibrating == self.is_running:
+            self.changed_since = None
+            return
+        if self.changed_since is None:
+            self.changed_since = now
+        if now - self.changed_since >= (self.start_time if is_vibrating else self.stop_time):
+            self.is_running = is_vibrating
+            self.changed_since = None
+            if self.on_change is not None:
+                self.on_change(self, is_vibrating)
+
+class VibrationMonitor:
+    def __init__(self, i2c_device, sample_rate = SAMPLE_RATE, **kwargs):
+        self.fifo = MPU6050_FIFO(i2c_device, sample_rate)
+        self.detector = VibrationDetector(sample_rate, **kwargs)
+        self.detector.on_change = self._detector_changed
+        self.started_time = None # last time the motor started running
+        self.start_count = 0
+        # Called with (monitor, is_running) when the motor starts or stops
+        self.on_change = None
+        self.fifo.start()
+
+    @property
+    def is_running(self):
+        return self.detector.is_running
+
+    # Call this often enough for the FIFO not to fill up (~850ms at 200Hz)
+    def update(self, now = None):
+        if now is None:
+            now = time.monotonic()
+        overflow_count = self.fifo.overflow_count
+        length = self.fifo.read()
+        if self.fifo.overflow_count != overflow_count:
+            # the samples before the overflow aren't contiguous with the new ones
+            self.detector.reset()
+        self.detector.add(self.fifo.buffer, length, now)
+
+    # rms=0.02 band=0.10 peak=0.85 starts=3 overflows=0
+    def get_summary(self):
+        detector = self.detector
+        return "rms={:.2f} band={:.2f} peak={:.2f} starts={} overflows={}".format(detector.rms, detector.band_fraction,
+                                                                                  detector.peak_rms, self.start_count,
+                                                                                  self.fifo.overflow_count)
+
+    def reset_stats(self):
+        self.detector.peak_rms = 0
+
+    def _detector_changed(self, detector, is_running):
+        if is_running:
+            self.started_time = time.monotonic()
+            self.start_count += 1
+        log.debug("Motor %s (rms=%.2f band=%.2f)", "running" if is_running else "stopped", detector.rms, detector.band_fraction)
+        if self.on_change is not None:
+            self.on_change(self, is_running)
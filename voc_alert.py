@@ -0,0 +1,63 @@
+# ATMegaZero VOC Alert
+#
+# Raises an alert when the VOC index stays high, like with a car idling in the
+# closed garage, and clears it once the air is back to normal. The index is
+# relative to the SGP40's own 24 hour baseline (100), so the same thresholds
+# work in any garage. A short spike (someone spraying paint for a second) isn't
+# enough: the index has to stay at or above `threshold` for `sustain_time`
+# seconds, then below `clear_threshold` for `clear_time` seconds to clear.
+# update() is called with every new index and only keeps a few numbers around.
+#
+# For full documentation please visit https://atmegazero.com
+
+import time
+
+VOC_ALERT_THRESHOLD = 250
+VOC_CLEAR_THRESHOLD = 150
+SUSTAIN_TIME = 60 # seconds
+CLEAR_TIME = 120 # seconds
+
+class VOCAlert:
+    def __init__(self, threshold = VOC_ALERT_THRESHOLD, clear_threshold = VOC_CLEAR_THRESHOLD,
+                 sustain_time = SUSTAIN_TIME, clear_time = CLEAR_TIME):
+        self.threshold = threshold
+        self.clear_threshold = clear_threshold
+        self.sustain_time = sustain_time
+        self.clear_time = clear_time
+
+        self.is_active = False
+        self.changed_since = None # when the index crossed the threshold that changes is_active
+        self.peak_index = 0 # highest index during the current (or last) alert
+        self.alert_count = 0
+        # Called with (alert, is_active) when the alert is raised or cleared
+        self.on_change = None
+
+    def update(self, index, now = None):
+        if now is None:
+            now = time.monotonic()
+
+        if self.is_active:
+            is_changing = index < self.clear_threshold
+            hold_time = self.clear_time
+        else:
+            is_changing = index >= self.threshold
+            hold_time = self.sustain_time
+
+        if is_changing and self.changed_since is None:
+            self.changed_since = now
+            if not self.is_active:
+                # a new spike
+                self.peak_index = 0
+        if index > self.peak_index and (self.is_active or is_changing):
+            self.peak_index = index
+        if not is_changing:
+            self.changed_since = None
+            return
+
+        if now - self.changed_since >= hold_time:
+            self.is_active = not self.is_active
+            self.changed_since = None
+            if self.is_active:
+                self.alert_count += 1
+            if self.on_change is not None:
+                self.on_change(self, self.is_active)